@@ -0,0 +1,212 @@
+"""Content-addressed on-disk cache of simulation results
+
+Results are keyed by a hash of everything that determines them: the starting
+state, the values of all model parameters, the integrator settings and the
+code of the model modules, without their docstrings and comments. Changing
+any of them changes the key, so stale results are never returned and
+unchanged scenarios are fetched instantly.
+
+Trajectories are stored as one .npz file per key. When the cache grows past
+its size limit the least recently used entries are evicted, where use is
+tracked by the file modification time.
+
+Classes
+-------
+ResultCache
+    The result cache
+"""
+import ast
+import hashlib
+import inspect
+import json
+import os
+from typing import Callable
+
+import numpy as np
+import pint
+
+import bioreactor
+import integrated_model
+import membrane
+import metrics
+import multirate
+import parameters
+import process_table
+import simulation
+import sludge
+from parameters import ureg
+
+# Modules whose source determines simulation results
+MODEL_MODULES = [integrated_model, bioreactor, membrane, sludge, parameters,
+                 simulation, multirate, process_table, metrics]
+MODEL_FILES = ['custom_units.txt']
+DEFAULT_DIRECTORY = os.path.join('.cache', 'results')
+
+
+def _describe(value) -> str:
+    """Stable text representation of a value for hashing
+
+    Anything but quantities, arrays, containers and plain values raises a
+    TypeError, as its repr may hold a memory address and could never hit
+    the cache.
+    """
+    if isinstance(value, pint.Quantity):
+        # Base units so equal quantities in different units hash the same
+        value = value.to_base_units()
+        return(f'{np.asarray(value.magnitude).tolist()!r} {value.units}')
+    elif isinstance(value, dict):
+        items = sorted(value.items())
+        return('{' + ', '.join(f'{k}: {_describe(v)}' for k, v in items)
+               + '}')
+    elif isinstance(value, (list, tuple)):
+        return('[' + ', '.join(_describe(v) for v in value) + ']')
+    elif isinstance(value, np.ndarray):
+        return(repr(value.tolist()))
+    elif value is None or isinstance(value, (str, int, float, np.number)):
+        return(repr(value))
+    raise TypeError(f'Cannot describe {type(value).__name__} for a cache '
+                    f'key')
+
+
+def _code(source: str) -> str:
+    """Syntax tree of Python source without docstrings and comments"""
+    tree = ast.parse(source)
+    for node in ast.walk(tree):
+        if (isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef,
+                              ast.AsyncFunctionDef))
+                and node.body and isinstance(node.body[0], ast.Expr)
+                and isinstance(node.body[0].value, ast.Constant)
+                and isinstance(node.body[0].value.value, str)):
+            node.body = node.body[1:] or [ast.Pass()]
+    return(ast.dump(tree))
+
+
+def model_version() -> str:
+    """Hash of the code of the model modules
+
+    Docstrings, comments and formatting do not change the version.
+    """
+    h = hashlib.sha256()
+    for m in MODEL_MODULES:
+        h.update(_code(inspect.getsource(m)).encode())
+    for name in MODEL_FILES:
+        with open(os.path.join(os.path.dirname(parameters.__file__), name),
+                  'rb') as f:
+            h.update(f.read())
+    return(h.hexdigest())
+
+
+def save_trajectory(file_path: str, trajectory: dict) -> None:
+    """Save a trajectory (see metrics.stack_states) as a .npz file"""
+    units = {k: str(v.units) for k, v in trajectory.items()}
+    arrays = {k: np.asarray(v.magnitude) for k, v in trajectory.items()}
+    with open(file_path, 'wb') as f:
+        np.savez(f, __units__=json.dumps(units), **arrays)
+
+
+def load_trajectory(file_path: str) -> dict:
+    """Load a trajectory saved with save_trajectory"""
+    with np.load(file_path) as f:
+        units = json.loads(str(f['__units__']))
+        trajectory = {k: ureg.Quantity(f[k], u) for k, u in units.items()}
+    return(trajectory)
+
+
+class ResultCache:
+    def __init__(self, directory: str = DEFAULT_DIRECTORY,
+                 max_bytes: int = 1024 ** 3) -> None:
+        """On-disk cache of simulation trajectories
+
+        Parameters
+        ----------
+        directory: str
+            Where cached trajectories are stored
+        max_bytes: int
+            Size limit of the cache, least recently used entries are evicted
+            above it
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = model_version()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, state: dict, settings: dict) -> str:
+        """Key of the result of simulating a state
+
+        Parameters
+        ----------
+        state: dict
+            Starting state
+        settings: dict
+            Integrator settings, e.g. time and t_step
+        Output
+        ------
+        key: str
+            Hex digest identifying the result
+        """
+        description = '\n'.join([_describe(state),
+                                 _describe(process_table.parameter_values()),
+                                 _describe(settings),
+                                 self.version])
+        return(hashlib.sha256(description.encode()).hexdigest())
+
+    def path(self, key: str) -> str:
+        return(os.path.join(self.directory, f'{key}.npz'))
+
+    def get(self, key: str) -> dict:
+        """Cached trajectory for a key or None if it is not cached"""
+        file_path = self.path(key)
+        try:
+            trajectory = load_trajectory(file_path)
+        except (FileNotFoundError, ValueError, KeyError, OSError):
+            self.misses += 1
+            return(None)
+        # Mark as recently used
+        os.utime(file_path)
+        self.hits += 1
+        return(trajectory)
+
+    def put(self, key: str, trajectory: dict) -> None:
+        """Store a trajectory and evict entries above the size limit"""
+        file_path = self.path(key)
+        # Write then rename so readers never see a partial file
+        tmp_path = f'{file_path}.{os.getpid()}.tmp'
+        save_trajectory(tmp_path, trajectory)
+        os.replace(tmp_path, file_path)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used entries until under max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def clear(self) -> None:
+        """Remove all cached entries"""
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.directory, name))
+
+    def run(self, state: dict, time: pint.Quantity, t_step: pint.Quantity,
+            progress: Callable = None, integrator: str = 'euler',
+            **options) -> dict:
+        """Cached version of simulation.run"""
+        key = self.key(state, {'time': time, 't_step': t_step,
+                               'integrator': integrator, **options})
+        trajectory = self.get(key)
+        if trajectory is None:
+            trajectory = simulation.run(state, time, t_step, progress,
+                                        integrator, **options)
+            self.put(key, trajectory)
+        return(trajectory)
@@ -0,0 +1,427 @@
+"""Model-predictive aeration and flux control
+
+A receding-horizon controller for the manipulated inputs in_S_O (oxygen
+supplied with the aeration), v_sg (membrane scouring air) and Q_out
+(permeate flow). Each decision simulates many candidate input trajectories
+at once as one batched forward run of the bioreactor and the membrane
+fouling path, scores them on energy, effluent COD and nitrogen and TMP
+growth, and applies the first move of the best one.
+
+Candidate trajectories are piecewise constant with one move per control
+interval. They are evaluated in batches sized from the measured cost of the
+previous batch, so the last batch ends within the wall-clock budget of the
+decision, which uses the best candidate found so far. The generated rate
+kernel, the parameters in base units and the library of candidate
+trajectories are built once per controller and reused by every decision.
+
+In this model the scouring shear stress does not feed back into fouling, so
+v_sg is traded off against a minimum shear stress instead of TMP growth.
+
+Classes
+-------
+Controller
+    The receding-horizon controller
+
+Methods
+-------
+step_batch -> tuple
+    Explicit Euler step of the bioreactor and membrane of many runs
+shear_shortfall -> np.ndarray
+    Shortfall of the scouring shear stress below a minimum
+"""
+import time as timer
+
+import numpy as np
+import pint
+
+import membrane
+import metrics
+import multirate
+import parameters
+import process_table
+from parameters import ureg
+
+# Manipulated inputs in the units their bounds are given in
+INPUTS = ['in_S_O', 'v_sg', 'Q_out']
+INPUT_UNITS = {
+    'in_S_O': ureg.mg / ureg.L,
+    'v_sg': ureg.cm / ureg.s,
+    'Q_out': ureg.m ** 3 / ureg.day,
+}
+# Cost per unit of each scored quantity (arbitrary monetary units)
+DEFAULT_WEIGHTS = {
+    'energy': 0.15,         # per kWh
+    'effluent_COD': 0.5,    # per kg COD discharged
+    'effluent_N': 3.0,      # per kg N discharged
+    'TMP_growth': 5.0,      # per kPa of TMP increase
+    'shear': 1e3,           # per Pa shortfall below the minimum shear stress
+    'volume': 1.0,          # per m^3 outside the allowed volume range
+}
+# Energy per kg of oxygen supplied, 1.8 kg O2/kWh aeration efficiency
+OXYGEN_ENERGY = 1 / 1.8 * (ureg.kWh / ureg.kg)
+# Specific energy of the scouring blowers
+SCOURING_ENERGY = 0.025 * (ureg.kWh / ureg.m ** 3)
+PUMP_EFFICIENCY = 0.7
+# Candidates in the first batch of a decision, which measures the cost of a
+# rollout, and the share of the remaining budget later batches are sized for
+PROBE_SIZE = 16
+BUDGET_MARGIN = 0.8
+# Membrane fouling state of batched runs, see step_batch
+FOULING_KEYS = ['R_i', 'R_r', 'm_rback', 'alpha_c', 'TMP']
+# Membrane parameters in base units
+MEMBRANE_PARAMETERS = {name: getattr(parameters, name).to_base_units()
+                       .magnitude
+                       for name in ['a', 'k_i', 'b', 'mu', 'R_m',
+                                    'back_transport_coefficient']}
+_SMP = [multirate.BIOLOGY_KEYS.index(k) for k in ['S_UAP', 'S_BAP']]
+_X_MLSS = multirate.BIOLOGY_KEYS.index('X_MLSS')
+_TSS = [multirate.BIOLOGY_KEYS.index(k) for k in multirate.TSS_KEYS]
+_TMP = FOULING_KEYS.index('TMP')
+
+
+def step_batch(kernel: process_table.Kernel, C: np.ndarray, V: np.ndarray,
+               fouling: np.ndarray, C_in: np.ndarray, Q_in: float,
+               Q: np.ndarray, T: float, membrane_density,
+               h: float) -> tuple:
+    """Explicit Euler step of the bioreactor and membrane of many runs
+
+    Works on magnitudes only, so sweeps over inputs or designs run as array
+    expressions instead of pint arithmetic per run and per step. This is the
+    fast path for screening studies, see design.optimize.
+
+    Parameters
+    ----------
+    kernel: process_table.Kernel
+        Generated rate kernel
+    C: np.ndarray
+        Concentrations of multirate.BIOLOGY_KEYS in base units with one
+        column per run
+    V: np.ndarray
+        Volume of every run in m^3
+    fouling: np.ndarray
+        FOULING_KEYS in base units with one column per run
+    C_in: np.ndarray
+        Feed concentrations like C
+    Q_in: float
+        Feed flow in m^3/s
+    Q: np.ndarray
+        Permeate flow of every run in m^3/s
+    T: float
+        Temperature in degC
+    membrane_density: float or np.ndarray
+        Membrane area per volume in m^2/m^3
+    h: float
+        The time step in seconds
+    Output
+    ------
+    C, V, fouling: np.ndarray
+        State after the step
+    pump_energy: np.ndarray
+        Energy of the permeate pump over the step in kWh
+    """
+    k = MEMBRANE_PARAMETERS
+    R_i, R_r, m_rback, alpha_c, _ = fouling
+    # Biology, as in Bioreactor.material_balance
+    r = np.zeros_like(C)
+    r[:-1] = kernel.reaction_rates(C[:-1], T)
+    m_total = C * V + (Q_in * C_in - Q * C + r * V) * h
+    C = np.maximum(m_total, 0) / V
+    V = V + (Q_in - Q) * h
+    # Membrane, as in Membrane.membrane_resistance
+    J = Q / (membrane_density * V)
+    SMP = C[_SMP[0]] + C[_SMP[1]]
+    X_MLSS = C[_X_MLSS]
+    R_dot_i = k['a'] * k['k_i'] * np.exp(k['b'] * J) * J * SMP
+    R_i = R_i + R_dot_i * h
+    R_r = R_r + alpha_c * (J * X_MLSS - m_rback) * h
+    TMP = J * k['mu'] * (k['R_m'] + R_i + R_r)
+    m_rback = k['back_transport_coefficient'] * X_MLSS
+    alpha_c = np.full_like(R_i, membrane.ALPHA_C.to_base_units().magnitude)
+    pump_energy = TMP * Q * h / PUMP_EFFICIENCY / 3.6e6
+    return(C, V, np.array([R_i, R_r, m_rback, alpha_c, TMP]), pump_energy)
+
+
+def shear_shortfall(v_sg: pint.Quantity, C: np.ndarray,
+                    temperature: pint.Quantity,
+                    min_shear: float) -> np.ndarray:
+    """Shortfall of the scouring shear stress below min_shear in Pa
+
+    Parameters
+    ----------
+    v_sg: pint.Quantity
+        Superficial gas velocity of every run
+    C: np.ndarray
+        Concentrations as in step_batch
+    temperature: pint.Quantity
+        The temperature
+    min_shear: float
+        Smallest acceptable shear stress in Pa
+    """
+    X_TSS = ureg.Quantity(0.75 * np.sum(C[_TSS], axis=0),
+                          ureg.kg / ureg.m ** 3)
+    tau_w = membrane.Membrane().air_scouring(v_sg, X_TSS, temperature)
+    return(np.maximum(min_shear - tau_w.to(ureg.Pa).magnitude, 0))
+
+
+class Controller:
+    def __init__(self, bounds: dict = None,
+                 control_interval: pint.Quantity = 30 * ureg.min,
+                 n_moves: int = 4, t_step: pint.Quantity = 5 * ureg.min,
+                 weights: dict = None, budget: float = 1.0,
+                 batch_size: int = 256, n_batches: int = 16,
+                 riser_area: pint.Quantity = 10 * ureg.m ** 2,
+                 min_shear: pint.Quantity = 0.1 * ureg.Pa,
+                 volume_range: tuple = (1400 * ureg.m ** 3,
+                                        1600 * ureg.m ** 3),
+                 seed: int = 0) -> None:
+        """Receding-horizon controller
+
+        Parameters
+        ----------
+        bounds: dict
+            (lower, upper) bounds of each of INPUTS as pint.Quantity objects.
+            Q_out defaults to the Q_min to Q_max range of the state.
+        control_interval: pint.Quantity
+            Length of each move, the first is applied before deciding again
+        n_moves: int
+            Number of moves in the prediction horizon
+        t_step: pint.Quantity
+            Time step of the rollouts
+        weights: dict
+            Cost weights, missing entries are taken from DEFAULT_WEIGHTS
+        budget: float
+            Wall-clock budget of a decision in seconds. Batches are sized
+            from the measured rollout cost to end within it, only the first
+            batch of PROBE_SIZE candidates always runs.
+        batch_size: int
+            Largest number of candidates simulated together
+        n_batches: int
+            Size of the candidate library in batches
+        riser_area: pint.Quantity
+            Cross section the scouring air rises through, sets the air flow
+            for a superficial gas velocity
+        min_shear: pint.Quantity
+            Shear stress the scouring air has to provide
+        volume_range: tuple
+            Allowed range of the reactor volume
+        seed: int
+            Seed of the candidate library
+        """
+        if bounds is None:
+            bounds = {}
+        self.bounds = {'in_S_O': (0 * ureg.mg / ureg.L, 8 * ureg.mg / ureg.L),
+                       'v_sg': (0.2 * ureg.cm / ureg.s,
+                                2 * ureg.cm / ureg.s)}
+        self.bounds.update(bounds)
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if weights is not None:
+            self.weights.update(weights)
+        self.control_interval = control_interval
+        self.n_moves = n_moves
+        self.n_steps = max(round((control_interval / t_step)
+                                 .to('').magnitude), 1)
+        self.h = control_interval.to(ureg.s).magnitude / self.n_steps
+        self.budget = budget
+        self.batch_size = batch_size
+        self.riser_area = riser_area.to(ureg.m ** 2).magnitude
+        self.min_shear = min_shear.to(ureg.Pa).magnitude
+        self.volume_range = [v.to(ureg.m ** 3).magnitude
+                             for v in volume_range]
+
+        # Cached for every decision
+        self.kernel = process_table.default_kernel()
+        self.oxygen_energy = OXYGEN_ENERGY.to(ureg.kWh / ureg.kg).magnitude
+        self.scouring_energy = SCOURING_ENERGY.to(
+            ureg.kWh / ureg.m ** 3).magnitude
+        # Permeate quality is linear in the concentrations
+        unit_states = self._trajectory(np.eye(len(multirate.BIOLOGY_KEYS)))
+        self.effluent_COD = (metrics.effluent_cod(unit_states)
+                             .to(ureg.kg / ureg.m ** 3).magnitude)
+        self.effluent_N = (metrics.effluent_total_nitrogen(unit_states)
+                           .to(ureg.kg / ureg.m ** 3).magnitude)
+        self.library = self._candidate_library(n_batches, seed)
+        self._S_O = multirate.BIOLOGY_KEYS.index('S_O')
+
+    def _candidate_library(self, n_batches: int, seed: int) -> np.ndarray:
+        """Candidate trajectories in coordinates scaled to [0, 1]
+
+        The first batch holds the current inputs (marked with NaN) and
+        constant trajectories on a grid, the rest are random piecewise
+        constant trajectories.
+        """
+        n_inputs = len(INPUTS)
+        levels = np.linspace(0, 1, 5)
+        grid = np.array(np.meshgrid(*[levels] * n_inputs, indexing='ij'))
+        grid = grid.reshape(n_inputs, -1).T
+        constant = np.repeat(grid[:, None, :], self.n_moves, axis=1)
+        hold = np.full((1, self.n_moves, n_inputs), np.nan)
+        rng = np.random.default_rng(seed)
+        n_random = max(n_batches * self.batch_size - len(constant) - 1, 0)
+        random = rng.random((n_random, self.n_moves, n_inputs))
+        return(np.concatenate([hold, constant, random]))
+
+    def _input_bounds(self, state: dict) -> np.ndarray:
+        bounds = dict(self.bounds)
+        bounds.setdefault('Q_out', (state['Q_min'], state['Q_max']))
+        return(np.array([[b.to(INPUT_UNITS[k]).magnitude for b in bounds[k]]
+                         for k in INPUTS]))
+
+    def rollout(self, state: dict, U: np.ndarray) -> dict:
+        """Simulate candidate input trajectories as one batch
+
+        Parameters
+        ----------
+        state: dict
+            State the rollouts start from
+        U: np.ndarray
+            Inputs in INPUT_UNITS with shape (candidates, moves, INPUTS)
+        Output
+        ------
+        scores: dict
+            Array of each scored quantity and the total cost per candidate
+        """
+        keys = multirate.BIOLOGY_KEYS
+        n = U.shape[0]
+        C = np.repeat(multirate.pack(state, keys)[:, None], n, axis=1)
+        C_in = np.repeat(multirate.pack(state, [f'in_{k}' for k in keys])
+                         [:, None], n, axis=1)
+        V = np.full(n, state['volume'].to(ureg.m ** 3).magnitude)
+        Q_in = state['Q_in'].to(ureg.m ** 3 / ureg.s).magnitude
+        T = state['temperature'].to(ureg.degC).magnitude
+        fouling = np.repeat(multirate.pack(state, FOULING_KEYS)[:, None], n,
+                            axis=1)
+        TMP_0 = state['TMP'].to(ureg.Pa).magnitude
+        membrane_density = state.get('membrane_density',
+                                     parameters.membrane_density)
+        membrane_density = membrane_density.to_base_units().magnitude
+        h = self.h
+
+        # Inputs in base units
+        in_S_O = ureg.Quantity(U[..., 0], INPUT_UNITS['in_S_O'])
+        in_S_O = in_S_O.to_base_units().magnitude
+        v_sg = ureg.Quantity(U[..., 1], INPUT_UNITS['v_sg'])
+        Q_out = ureg.Quantity(U[..., 2], INPUT_UNITS['Q_out'])
+        Q_out = Q_out.to(ureg.m ** 3 / ureg.s).magnitude
+
+        energy = np.zeros(n)
+        effluent = {'COD': np.zeros(n), 'N': np.zeros(n)}
+        shear = np.zeros(n)
+        volume = np.zeros(n)
+        for move in range(self.n_moves):
+            C_in[self._S_O] = in_S_O[:, move]
+            Q = Q_out[:, move]
+            for _ in range(self.n_steps):
+                C, V, fouling, pump_energy = step_batch(
+                    self.kernel, C, V, fouling, C_in, Q_in, Q, T,
+                    membrane_density, h)
+                # Effluent loads and energy over the step
+                effluent['COD'] += self.effluent_COD @ C * Q * h
+                effluent['N'] += self.effluent_N @ C * Q * h
+                energy += Q_in * in_S_O[:, move] * h * self.oxygen_energy
+                energy += pump_energy
+                volume += (np.maximum(self.volume_range[0] - V, 0)
+                           + np.maximum(V - self.volume_range[1], 0))
+            air = (v_sg[:, move].to(ureg.m / ureg.s).magnitude
+                   * self.riser_area * h * self.n_steps)
+            energy += air * self.scouring_energy
+            shear += shear_shortfall(v_sg[:, move], C, state['temperature'],
+                                     self.min_shear)
+
+        scores = {'energy': energy,
+                  'effluent_COD': effluent['COD'],
+                  'effluent_N': effluent['N'],
+                  'TMP_growth': (fouling[_TMP] - TMP_0) / 1000,
+                  'shear': shear / self.n_moves,
+                  'volume': volume / (self.n_moves * self.n_steps)}
+        scores['cost'] = sum(self.weights[k] * v for k, v in scores.items())
+        return(scores)
+
+    def _trajectory(self, C: np.ndarray) -> dict:
+        """Concentrations in base units as a trajectory for metrics"""
+        units = ureg.kg / ureg.m ** 3
+        return({k: ureg.Quantity(C[i], units)
+                for i, k in enumerate(multirate.BIOLOGY_KEYS)})
+
+    def decide(self, state: dict) -> tuple:
+        """Choose the inputs to apply until the next decision
+
+        Parameters
+        ----------
+        state: dict
+            Current state of the plant
+        Output
+        ------
+        inputs: dict
+            First move of the best candidate as pint.Quantity objects
+        info: dict
+            Cost of the best candidate, number of candidates evaluated and
+            the wall time of the decision in seconds
+        """
+        start = timer.perf_counter()
+        bounds = self._input_bounds(state)
+        lo, hi = bounds[:, 0], bounds[:, 1]
+        current = np.array([state[k].to(INPUT_UNITS[k]).magnitude
+                            for k in INPUTS])
+        U_all = lo + (hi - lo) * self.library
+        U_all = np.where(np.isnan(U_all), np.clip(current, lo, hi), U_all)
+
+        best_cost = np.inf
+        best = None
+        evaluated = 0
+        # Every batch is sized to end within the budget, assuming it costs
+        # the whole small probe batch (the fixed overhead of a rollout) plus
+        # the seconds per candidate measured on the previous batch
+        overhead = None
+        size = min(PROBE_SIZE, self.batch_size)
+        while evaluated < len(U_all):
+            if overhead is not None:
+                remaining = self.budget - (timer.perf_counter() - start)
+                size = min(self.batch_size, int(
+                    (BUDGET_MARGIN * remaining - overhead) / per_candidate))
+                if size < 1:
+                    break
+            U = U_all[evaluated:evaluated + size]
+            batch_start = timer.perf_counter()
+            cost = self.rollout(state, U)['cost']
+            elapsed = timer.perf_counter() - batch_start
+            per_candidate = elapsed / len(U)
+            if overhead is None:
+                overhead = elapsed
+            j = np.argmin(cost)
+            if cost[j] < best_cost:
+                best_cost = cost[j]
+                best = U[j]
+            evaluated += len(U)
+        inputs = {k: best[0, i] * INPUT_UNITS[k]
+                  for i, k in enumerate(INPUTS)}
+        info = {'cost': float(best_cost), 'evaluated': evaluated,
+                'elapsed': timer.perf_counter() - start}
+        return(inputs, info)
+
+    def run(self, model, time: pint.Quantity,
+            t_step: pint.Quantity = 5 * ureg.min) -> list:
+        """Control a model in closed loop
+
+        Parameters
+        ----------
+        model: integrated_model.MBRModel
+            The controlled model, e.g. a multirate.MultirateModel
+        time: pint.Quantity
+            How long to control for
+        t_step: pint.Quantity
+            Time step of the model
+        Output
+        ------
+        decisions: list
+            The time, inputs and info of every decision
+        """
+        end = model.state['time'] + time
+        decisions = []
+        while model.state['time'] < end:
+            inputs, info = self.decide(model.state)
+            model.state.update(inputs)
+            decisions.append({'time': model.state['time'], **inputs, **info})
+            next_decision = model.state['time'] + self.control_interval
+            while model.state['time'] < min(next_decision, end):
+                model.step_model(t_step)
+        return(decisions)
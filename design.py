@@ -0,0 +1,389 @@
+"""Batched design optimization for membrane area, tank volume and aeration
+
+Sizing studies choose membrane_density, volume and v_sg to trade TMP growth
+against capital and energy cost. The permeate flow of every design is the
+feed flow of the state, so the tank runs at its design volume and designs
+differ in flux rather than in how fast they drain or fill the tank. optimize
+searches the design bounds without derivatives: every round draws a Latin
+hypercube sample of candidate designs in a box that shrinks around the best
+design found so far, which competes again in the round. The candidates of a
+round are simulated together as one batch on arrays (controller.step_batch,
+shared with the controller's rollouts) and runs that are clearly dominated
+are terminated early by successive halving: all candidates run for a short
+part of the horizon, only the cheapest fraction continues for longer, and so
+on until the survivors reach the full horizon. Costs are per m^3 of
+permeate, so partial runs can be compared with each other.
+
+As in the controller, the scouring shear stress does not feed back into
+fouling in this model, so v_sg is traded off against a minimum shear stress.
+
+Classes
+-------
+DesignBatch
+    Batch of candidate designs simulated together
+
+Methods
+-------
+apply_design -> dict
+    State with a design applied
+specific_cost -> np.ndarray
+    Default objective, cost per m^3 of permeate
+optimize -> dict
+    Search the design bounds for the design of lowest cost
+"""
+import concurrent.futures
+import math
+import time as timer
+from typing import Callable
+
+import numpy as np
+import pint
+from scipy.stats import qmc
+
+import controller
+import multirate
+import process_table
+import state as state_module
+from parameters import ureg
+
+# Design variables in the units their bounds are given in
+DESIGN_VARIABLES = ['membrane_density', 'volume', 'v_sg']
+DESIGN_UNITS = {
+    'membrane_density': ureg.m ** 2 / ureg.m ** 3,
+    'volume': ureg.m ** 3,
+    'v_sg': ureg.cm / ureg.s,
+}
+DEFAULT_BOUNDS = {
+    'membrane_density': (20 * DESIGN_UNITS['membrane_density'],
+                         80 * DESIGN_UNITS['membrane_density']),
+    'volume': (1000 * ureg.m ** 3, 2500 * ureg.m ** 3),
+    'v_sg': (0.2 * ureg.cm / ureg.s, 3 * ureg.cm / ureg.s),
+}
+# Cost per unit of each scored quantity (arbitrary monetary units as in
+# controller.DEFAULT_WEIGHTS)
+DEFAULT_WEIGHTS = {
+    'capital': 1.0,         # per unit of depreciated capital
+    'energy': controller.DEFAULT_WEIGHTS['energy'],  # per kWh
+    'TMP_growth': 200.0,    # per kPa of TMP increase, share of a cleaning
+    'shear': 1e6,           # per Pa shortfall below the minimum shear stress
+}
+# Installed cost and service life of the membranes and the tank
+MEMBRANE_COST = 40 / ureg.m ** 2
+MEMBRANE_LIFE = 10 * ureg.year
+TANK_COST = 600 / ureg.m ** 3
+TANK_LIFE = 30 * ureg.year
+# Array attributes of DesignBatch with the designs along the last axis
+PER_DESIGN = ['density', 'V_design', 'v_sg', 'area', 'C', 'C_in', 'V',
+              'fouling', 'TMP_0', 'energy', 'permeate', 'shear']
+_TMP = controller.FOULING_KEYS.index('TMP')
+
+
+def apply_design(state: dict, design: dict) -> dict:
+    """Copy of a state with the variables of a design replaced
+
+    The membrane density is stored in the state, where Membrane.step picks
+    it up instead of parameters.membrane_density.
+    """
+    new_state = state.copy()
+    new_state.update(design)
+    return(new_state)
+
+
+class DesignBatch:
+    def __init__(self, state: dict, designs: np.ndarray,
+                 riser_area: pint.Quantity = 10 * ureg.m ** 2,
+                 min_shear: pint.Quantity = 0.1 * ureg.Pa) -> None:
+        """Candidate designs simulated together
+
+        Parameters
+        ----------
+        state: dict
+            State every design starts from, see state.py. Its feed flow is
+            the permeate flow of every design.
+        designs: np.ndarray
+            Designs in DESIGN_UNITS with shape (candidates, DESIGN_VARIABLES)
+        riser_area: pint.Quantity
+            Cross section of the scouring air risers
+        min_shear: pint.Quantity
+            Smallest acceptable scouring shear stress
+        """
+        n = len(designs)
+        keys = multirate.BIOLOGY_KEYS
+        self.designs = np.asarray(designs, dtype=float)
+        self.kernel = process_table.default_kernel()
+        self.riser_area = riser_area.to(ureg.m ** 2).magnitude
+        self.min_shear = min_shear.to(ureg.Pa).magnitude
+        self.temperature = state['temperature']
+        self.T = state['temperature'].to(ureg.degC).magnitude
+        self.Q_in = state['Q_in'].to(ureg.m ** 3 / ureg.s).magnitude
+
+        # Design variables in base units
+        design = {k: ureg.Quantity(self.designs[:, i], DESIGN_UNITS[k])
+                  .to_base_units().magnitude
+                  for i, k in enumerate(DESIGN_VARIABLES)}
+        self.density = design['membrane_density']
+        self.V_design = design['volume']
+        self.v_sg = design['v_sg']
+        self.area = self.density * self.V_design
+
+        # Dynamic state, one column per design
+        self.C = np.repeat(multirate.pack(state, keys)[:, None], n, axis=1)
+        self.C_in = np.repeat(multirate.pack(state, [f'in_{k}' for k in keys])
+                              [:, None], n, axis=1)
+        self.V = self.V_design.copy()
+        self.fouling = np.repeat(
+            multirate.pack(state, controller.FOULING_KEYS)[:, None], n,
+            axis=1)
+        self.TMP_0 = np.full(n, np.nan)
+        # Accumulated over the simulated time
+        self.t = 0.0
+        self.energy = np.zeros(n)
+        self.permeate = np.zeros(n)
+        self.shear = np.zeros(n)
+
+    def __len__(self) -> int:
+        return(len(self.designs))
+
+    def advance(self, time: pint.Quantity,
+                t_step: pint.Quantity) -> 'DesignBatch':
+        """Simulate every design of the batch further
+
+        Parameters
+        ----------
+        time: pint.Quantity
+            Length of the advance
+        t_step: pint.Quantity
+            The time step
+        """
+        H = time.to(ureg.s).magnitude
+        n_steps = max(math.ceil(H / t_step.to(ureg.s).magnitude - 1e-9), 1)
+        h = H / n_steps
+        C, V, fouling = self.C, self.V, self.fouling
+        # Designs that foul without bound end up with NaN costs and are
+        # dropped by optimize
+        with np.errstate(all='ignore'):
+            for _ in range(n_steps):
+                C, V, fouling, pump_energy = controller.step_batch(
+                    self.kernel, C, V, fouling, self.C_in, self.Q_in,
+                    self.Q_in, self.T, self.density, h)
+                # TMP growth is counted from the first step on
+                self.TMP_0 = np.where(np.isnan(self.TMP_0),
+                                      fouling[_TMP], self.TMP_0)
+                self.energy += pump_energy
+                self.permeate += self.Q_in * h
+        self.C, self.V, self.fouling = C, V, fouling
+
+        # Scouring air and shear stress over the advance
+        air = self.v_sg * self.riser_area * H
+        self.energy += air * controller.SCOURING_ENERGY.to(
+            ureg.kWh / ureg.m ** 3).magnitude
+        self.shear += controller.shear_shortfall(
+            self.v_sg * ureg.m / ureg.s, C, self.temperature,
+            self.min_shear) * H
+        self.t += H
+        return(self)
+
+    def select(self, index: np.ndarray) -> 'DesignBatch':
+        """Batch of a subset of the designs, e.g. to drop dominated ones"""
+        batch = DesignBatch.__new__(DesignBatch)
+        batch.__dict__.update(self.__dict__)
+        for name in PER_DESIGN:
+            setattr(batch, name, getattr(self, name)[..., index])
+        batch.designs = self.designs[index]
+        return(batch)
+
+    @classmethod
+    def concatenate(cls, batches: list) -> 'DesignBatch':
+        """One batch of the designs of several batches"""
+        batch = cls.__new__(cls)
+        batch.__dict__.update(batches[0].__dict__)
+        for name in PER_DESIGN:
+            setattr(batch, name, np.concatenate(
+                [getattr(b, name) for b in batches], axis=-1))
+        batch.designs = np.concatenate([b.designs for b in batches])
+        return(batch)
+
+    def scores(self) -> dict:
+        """Scored quantities of every design over the simulated time
+
+        Output
+        ------
+        scores: dict
+            Arrays of depreciated capital, energy in kWh, TMP growth in kPa,
+            mean shear stress shortfall in Pa and permeate in m^3
+        """
+        capital_rate = (self.area * (MEMBRANE_COST / MEMBRANE_LIFE)
+                        .to(1 / ureg.m ** 2 / ureg.s).magnitude
+                        + self.V_design * (TANK_COST / TANK_LIFE)
+                        .to(1 / ureg.m ** 3 / ureg.s).magnitude)
+        return({'capital': capital_rate * self.t,
+                'energy': self.energy,
+                'TMP_growth': (self.fouling[_TMP] - self.TMP_0) / 1000,
+                'shear': self.shear / self.t,
+                'permeate': self.permeate})
+
+
+def specific_cost(scores: dict, weights: dict = None) -> np.ndarray:
+    """Weighted cost per m^3 of permeate, the default objective
+
+    Parameters
+    ----------
+    scores: dict
+        See DesignBatch.scores
+    weights: dict
+        Cost per unit of each score, DEFAULT_WEIGHTS for those not given
+    """
+    w = dict(DEFAULT_WEIGHTS)
+    if weights is not None:
+        w.update(weights)
+    cost = sum(w[k] * scores[k] for k in w)
+    return(cost / scores['permeate'])
+
+
+def _advance(batch: DesignBatch, time: pint.Quantity,
+             t_step: pint.Quantity) -> DesignBatch:
+    return(batch.advance(time, t_step))
+
+
+def _advance_parallel(batch: DesignBatch, time: pint.Quantity,
+                      t_step: pint.Quantity, executor,
+                      workers: int) -> DesignBatch:
+    if executor is None or len(batch) < 2:
+        return(batch.advance(time, t_step))
+    n_chunks = min(workers, len(batch))
+    chunks = [batch.select(index)
+              for index in np.array_split(np.arange(len(batch)), n_chunks)]
+    futures = [executor.submit(_advance, chunk, time, t_step)
+               for chunk in chunks]
+    return(DesignBatch.concatenate([f.result() for f in futures]))
+
+
+def optimize(bounds: dict = None, objective: Callable = specific_cost,
+             state: dict = state_module.starting_state,
+             time: pint.Quantity = 7 * ureg.day,
+             t_step: pint.Quantity = 5 * ureg.min,
+             n_candidates: int = 128, n_rounds: int = 4, n_rungs: int = 3,
+             eta: int = 3, shrink: float = 0.5, workers: int = None,
+             seed: int = 0, progress: Callable = None, **options) -> dict:
+    """Search the design bounds for the design of lowest cost
+
+    Parameters
+    ----------
+    bounds: dict
+        (lower, upper) bounds of each of DESIGN_VARIABLES as pint.Quantity
+        objects, DEFAULT_BOUNDS for those not given. Fixing a variable to
+        one value takes it out of the search.
+    objective: Callable
+        Maps DesignBatch.scores to the cost of every design
+    state: dict
+        State every design starts from
+    time: pint.Quantity
+        Horizon of the full runs
+    t_step: pint.Quantity
+        The time step
+    n_candidates: int
+        Designs sampled per round
+    n_rounds: int
+        Number of rounds, the search box shrinks after each
+    n_rungs: int
+        Number of successive halving stages, the first runs for
+        time / eta ** (n_rungs - 1)
+    eta: int
+        Only the cheapest 1 / eta of the runs continue after each stage
+    shrink: float
+        Factor the width of the search box is multiplied by every round
+    workers: int
+        Number of worker processes a batch is split over, the batches are
+        simulated in this process if None
+    seed: int
+        Seed of the Latin hypercube samples
+    progress: Callable
+        Called with the round number and the best result so far, after
+        every round that has a design of finite cost
+    options:
+        Passed on to DesignBatch
+    Output
+    ------
+    result: dict
+        Best design as pint.Quantity objects, its cost and scores, the best
+        cost after every round, the number of designs evaluated, the number
+        of simulated design-days and the wall time in seconds
+    """
+    start = timer.perf_counter()
+    b = dict(DEFAULT_BOUNDS)
+    if bounds is not None:
+        b.update(bounds)
+    lo = np.array([b[k][0].to(DESIGN_UNITS[k]).magnitude
+                   for k in DESIGN_VARIABLES])
+    hi = np.array([b[k][1].to(DESIGN_UNITS[k]).magnitude
+                   for k in DESIGN_VARIABLES])
+    rungs = [time / eta ** (n_rungs - 1 - i) for i in range(n_rungs)]
+    sampler = qmc.LatinHypercube(d=len(DESIGN_VARIABLES), seed=seed)
+
+    executor = None
+    if workers is not None:
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+    best = {'cost': np.inf}
+    history = []
+    evaluated = 0
+    simulated = 0 * ureg.day
+    center = np.full(len(DESIGN_VARIABLES), 0.5)
+    width = 1.0
+    try:
+        for i in range(n_rounds):
+            # Latin hypercube sample of the current box in [0, 1]
+            box_lo = np.clip(center - width / 2, 0, 1 - width)
+            x = box_lo + width * sampler.random(n_candidates)
+            designs = lo + (hi - lo) * x
+            # The best design so far competes again, so a round never loses
+            # it to a worse sample
+            if 'design' in best:
+                designs = np.vstack([incumbent, designs])
+            batch = DesignBatch(state, designs, **options)
+            evaluated += len(batch)
+            elapsed = 0 * ureg.s
+            for j, rung in enumerate(rungs):
+                batch = _advance_parallel(batch, rung - elapsed, t_step,
+                                          executor, workers)
+                simulated += len(batch) * (rung - elapsed)
+                elapsed = rung
+                cost = np.nan_to_num(objective(batch.scores()), nan=np.inf)
+                keep = np.argsort(cost)
+                if j < n_rungs - 1:
+                    keep = keep[:max(math.ceil(len(batch) / eta), 1)]
+                    batch = batch.select(keep)
+            # Survivors ran the full horizon
+            j = keep[0]
+            if cost[j] < best['cost']:
+                scores = batch.scores()
+                best = {'design': {k: batch.designs[j, m] * DESIGN_UNITS[k]
+                                   for m, k in enumerate(DESIGN_VARIABLES)},
+                        'cost': float(cost[j]),
+                        'scores': {k: float(v[j]) for k, v in scores.items()}}
+                incumbent = batch.designs[j]
+                center = (incumbent - lo) / np.where(hi > lo, hi - lo, 1)
+            history.append(best['cost'])
+            width *= shrink
+            if progress is not None and 'design' in best:
+                progress(i, best)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if 'design' not in best:
+        raise ValueError(f'No feasible design: all {evaluated} designs ended '
+                         f'with a NaN or infinite cost')
+    best.update({'history': history, 'evaluated': evaluated,
+                 'simulated': simulated.to(ureg.day),
+                 'elapsed': timer.perf_counter() - start})
+    return(best)
+
+
+if __name__ == '__main__':
+    def report(i, best):
+        design = ', '.join(f'{k} = {v:.4g~P}'
+                           for k, v in best['design'].items())
+        print(f'Round {i + 1}: cost {best["cost"]:.4g} per m^3 ({design})')
+
+    result = optimize(progress=report)
+    print(f'{result["evaluated"]} designs, {result["simulated"]:.0f~P} '
+          f'simulated in {result["elapsed"]:.1f} s')
@@ -0,0 +1,205 @@
+"""Copy-on-write forking of simulation runs for what-if branches
+
+A Run is a model together with the history of states it went through. Run.fork
+snapshots a run at its current time: the branch shares the membrane and
+bioreactor models, generated kernels and parameter sets of its parent and
+its history only points at the parent's history, so a fork costs a dict copy
+no matter how long the parent ran. State variables are immutable pint
+quantities, so the copied state shares all of them until the branch
+overwrites one. Every branch records only its divergent tail.
+
+Many branches from the same point are advanced concurrently with
+run_branches, which ships only the branch models to worker processes.
+
+Classes
+-------
+History
+    States recorded by a run, sharing the states recorded before a fork
+Run
+    A model and its history that can be forked
+
+Methods
+-------
+run_branches -> dict
+    Fork a run into branches with changed inputs and advance them
+    concurrently
+"""
+import concurrent.futures
+import copy
+from typing import Callable
+
+import pint
+
+import metrics
+import simulation
+from parameters import ureg
+
+
+class History:
+    def __init__(self, parent: 'History' = None, offset: int = 0) -> None:
+        """States recorded by a run
+
+        Parameters
+        ----------
+        parent: History
+            History of the run this run was forked from
+        offset: int
+            Number of states of parent that belong to this history
+        """
+        self.parent = parent
+        self.offset = offset
+        self.tail = []
+
+    def __len__(self) -> int:
+        return(self.offset + len(self.tail))
+
+    def __iter__(self):
+        # Walk up to the root first so that deep chains of forks do not
+        # recurse
+        segments = []
+        history, n = self, len(self)
+        while history is not None:
+            segments.append(history.tail[:n - history.offset])
+            n = min(n, history.offset)
+            history = history.parent
+        for segment in reversed(segments):
+            yield from segment
+
+    def append(self, state: dict) -> None:
+        self.tail.append(state)
+
+    def fork(self) -> 'History':
+        """History of a branch starting at the current state"""
+        return(History(self, len(self)))
+
+    def trajectory(self, tail_only: bool = False) -> dict:
+        """Recorded states as a trajectory, see metrics.stack_states
+
+        Parameters
+        ----------
+        tail_only: bool
+            Only the states recorded since the fork if True
+        """
+        states = self.tail if tail_only else list(self)
+        return(metrics.stack_states(states))
+
+
+class Run:
+    def __init__(self, model, history: History = None) -> None:
+        """A model and the states it went through
+
+        Parameters
+        ----------
+        model: integrated_model.MBRModel
+            Model at the current state of the run
+        history: History
+            States recorded so far, empty if None
+        """
+        self.model = model
+        if history is None:
+            history = History()
+        self.history = history
+
+    @classmethod
+    def start(cls, state: dict, integrator: str = 'euler',
+              **options) -> 'Run':
+        """Start a run from a state
+
+        Parameters
+        ----------
+        state: dict
+            Starting state, see state.py. It is not modified.
+        integrator: str
+            See simulation.model_class
+        options:
+            Passed on to the model constructor
+        """
+        model = simulation.model_class(integrator)(state.copy(), **options)
+        return(cls(model))
+
+    @property
+    def state(self) -> dict:
+        return(self.model.state)
+
+    def advance(self, time: pint.Quantity, t_step: pint.Quantity,
+                progress: Callable = None) -> 'Run':
+        """Step the run forward and record every state
+
+        Parameters
+        ----------
+        time: pint.Quantity
+            Length of the advance
+        t_step: pint.Quantity
+            The time step
+        progress: Callable
+            Called with the simulated time before every step
+        """
+        t = 0 * ureg.s
+        while t < time:
+            if progress is not None:
+                progress(t)
+            # A copy, so changing the inputs of the run later does not
+            # rewrite its history or that of its branches
+            self.history.append(dict(self.model.step_model(t_step)))
+            t += t_step
+        return(self)
+
+    def fork(self, changes: dict = None) -> 'Run':
+        """Branch off the run at its current state
+
+        Parameters
+        ----------
+        changes: dict
+            State variables to change in the branch, e.g. {'Q_out': ...}
+        Output
+        ------
+        branch: Run
+            Run sharing everything with this run but its state, which can
+            be advanced independently
+        """
+        model = copy.copy(self.model)
+        model.state = self.model.state.copy()
+        if changes is not None:
+            model.state.update(changes)
+        return(Run(model, self.history.fork()))
+
+    def trajectory(self, tail_only: bool = False) -> dict:
+        """See History.trajectory"""
+        return(self.history.trajectory(tail_only))
+
+
+def _advance(model, time: pint.Quantity, t_step: pint.Quantity) -> tuple:
+    run = Run(model).advance(time, t_step)
+    return(run.model, run.history.tail)
+
+
+def run_branches(base: Run, branches: dict, time: pint.Quantity,
+                 t_step: pint.Quantity, workers: int = None) -> dict:
+    """Fork a run into branches and advance them concurrently
+
+    Parameters
+    ----------
+    base: Run
+        Run to branch off at its current state, it is not advanced
+    branches: dict
+        Changed state variables of each branch by branch name
+    time: pint.Quantity
+        Forward horizon of every branch
+    t_step: pint.Quantity
+        The time step
+    workers: int
+        Number of worker processes, one per CPU if None
+    Output
+    ------
+    runs: dict
+        Advanced branch of each name
+    """
+    runs = {name: base.fork(changes) for name, changes in branches.items()}
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = {name: executor.submit(_advance, run.model, time, t_step)
+                   for name, run in runs.items()}
+        for name, future in futures.items():
+            model, tail = future.result()
+            runs[name].model = model
+            runs[name].history.tail = tail
+    return(runs)
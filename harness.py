@@ -0,0 +1,281 @@
+"""Accuracy-vs-speed harness with golden reference trajectories
+
+Golden trajectories are high-accuracy solutions of the state.starting_state
+scenario and the scenarios of plots.generate_data, stored on disk once with
+generate_golden. Candidate configurations (time step, integrator, kernel
+backend) are then run on every scenario and compared against the golden
+files on COD, SMP, EPS, total nitrogen, R_t and TMP. The result is a table
+of errors against wall time and steps per second with the Pareto optimal
+configurations marked, so the fastest configuration within a tolerance can
+be picked.
+
+A configuration is a dict with a name, t_step, integrator ('euler' for the
+pint based monolithic solve or 'multirate' for the generated kernel) and any
+options of the integrator's model class. Candidates are compared at the time
+points they share with the golden trajectories, so t_step must be a multiple
+of the t_step of REFERENCE.
+
+Methods
+-------
+generate_golden -> dict
+    Compute and store the golden trajectories
+evaluate -> list
+    Run candidate configurations against the golden trajectories
+pareto_table -> str
+    Format the results of evaluate
+fastest_within -> dict
+    Fastest configuration within a tolerance
+"""
+import argparse
+import json
+import os
+import time as timer
+import warnings
+
+import numpy as np
+import pint
+
+import cache
+import metrics
+import plots
+import simulation
+import state as state_module
+from parameters import ureg
+
+DEFAULT_DIRECTORY = 'golden'
+# Reference configuration, the biology is integrated with BDF at tight
+# tolerances and sampled every 5 minutes. The membrane is advanced with
+# explicit 5 minute steps, refining them to 1 minute changes R_t and TMP of
+# starting_state over a day by less than 1e-14 relative, so the membrane
+# error of the reference is far below that of any candidate. Candidate time
+# steps must be multiples of 5 minutes, see errors.
+REFERENCE = {'name': 'reference', 't_step': 5 * ureg.min,
+             'integrator': 'multirate', 'method': 'bdf', 'rtol': 1e-10,
+             'atol': 1e-14}
+# Compared metrics in the units they are reported in
+METRICS = {
+    'COD': (metrics.cod, ureg.mg / ureg.L),
+    'SMP': (metrics.smp, ureg.mg / ureg.L),
+    'EPS': (lambda t: t['X_EPS'], ureg.mg / ureg.L),
+    'N': (metrics.total_nitrogen, ureg.mg / ureg.L),
+    'R_t': (lambda t: t['R_t'], 1 / ureg.m),
+    'TMP': (lambda t: t['TMP'], ureg.kPa),
+}
+CANDIDATES = [
+    {'name': 'euler 5 min', 't_step': 5 * ureg.min, 'integrator': 'euler'},
+    {'name': 'euler 15 min', 't_step': 15 * ureg.min,
+     'integrator': 'euler'},
+    {'name': 'kernel 5 min', 't_step': 5 * ureg.min,
+     'integrator': 'multirate', 'substep': 5 * ureg.min},
+    {'name': 'multirate 1 h / 5 min', 't_step': 1 * ureg.hour,
+     'integrator': 'multirate', 'substep': 5 * ureg.min},
+    {'name': 'multirate 1 h / 15 min', 't_step': 1 * ureg.hour,
+     'integrator': 'multirate', 'substep': 15 * ureg.min},
+    {'name': 'multirate 1 h bdf', 't_step': 1 * ureg.hour,
+     'integrator': 'multirate', 'method': 'bdf', 'rtol': 1e-6},
+    {'name': 'multirate 6 h bdf', 't_step': 6 * ureg.hour,
+     'integrator': 'multirate', 'method': 'bdf', 'rtol': 1e-6},
+]
+
+
+def scenarios() -> dict:
+    """Starting states of all scenarios by name"""
+    states = {'starting_state': state_module.starting_state}
+    for i, s in enumerate(plots.scenarios()):
+        states[f'scenario_{i + 1}'] = s
+    return(states)
+
+
+def _run(state: dict, time: pint.Quantity, config: dict) -> dict:
+    options = {k: v for k, v in config.items()
+               if k not in ('name', 't_step', 'integrator')}
+    return(simulation.run(state, time, config['t_step'],
+                          integrator=config['integrator'], **options))
+
+
+def generate_golden(time: pint.Quantity = 1 * ureg.day,
+                    directory: str = DEFAULT_DIRECTORY,
+                    reference: dict = REFERENCE) -> dict:
+    """Compute and store the golden trajectories of all scenarios
+
+    Parameters
+    ----------
+    time: pint.Quantity
+        Length of each trajectory
+    directory: str
+        Where the golden files are written
+    reference: dict
+        Configuration used for the golden trajectories
+    Output
+    ------
+    golden: dict
+        Golden trajectory of each scenario
+    """
+    os.makedirs(directory, exist_ok=True)
+    golden = {}
+    for name, state in scenarios().items():
+        golden[name] = _run(state, time, reference)
+        cache.save_trajectory(os.path.join(directory, f'{name}.npz'),
+                              golden[name])
+    manifest = {'time': str(time), 'model_version': cache.model_version(),
+                'reference': {k: str(v) for k, v in reference.items()}}
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return(golden)
+
+
+def load_golden(directory: str = DEFAULT_DIRECTORY,
+                allow_stale: bool = False) -> dict:
+    """Golden trajectories written by generate_golden
+
+    Parameters
+    ----------
+    directory: str
+        Where the golden files are
+    allow_stale: bool
+        Use golden files made with a different model version with a
+        warning instead of raising a ValueError
+    """
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['model_version'] != cache.model_version():
+        message = (f'The model changed since the golden files in '
+                   f'{directory} were made, generate them again')
+        if not allow_stale:
+            raise ValueError(message)
+        warnings.warn(message)
+    return({name: cache.load_trajectory(os.path.join(directory,
+                                                     f'{name}.npz'))
+            for name in scenarios()})
+
+
+def errors(golden: dict, trajectory: dict) -> dict:
+    """Errors of a trajectory on every metric of METRICS
+
+    Only the time points of the trajectory that are also golden time points
+    are compared, like in multirate.compare, so no interpolation error is
+    counted against the trajectory.
+
+    Output
+    ------
+    errors: dict
+        Maximum and RMS error of each metric relative to the largest golden
+        magnitude
+    """
+    t_golden = golden['time'].to(ureg.s).magnitude
+    t = trajectory['time'].to(ureg.s).magnitude
+    index = np.searchsorted(t_golden, t)
+    keep = (index < len(t_golden))
+    keep[keep] = np.isclose(t_golden[index[keep]], t[keep])
+    if not np.any(keep):
+        raise ValueError('The trajectory shares no time points with the '
+                         'golden trajectory')
+    result = {}
+    for name, (metric, units) in METRICS.items():
+        y_golden = metric(golden).to(units).magnitude
+        y = metric(trajectory).to(units).magnitude
+        error = np.abs(y[keep] - y_golden[index[keep]])
+        scale = np.max(np.abs(y_golden)) or 1
+        result[f'{name}_max'] = float(np.max(error, initial=0) / scale)
+        result[f'{name}_rms'] = float(np.sqrt(np.mean(error ** 2)) / scale)
+    return(result)
+
+
+def evaluate(candidates: list = CANDIDATES,
+             directory: str = DEFAULT_DIRECTORY,
+             allow_stale: bool = False) -> list:
+    """Run candidate configurations against the golden trajectories
+
+    Parameters
+    ----------
+    candidates: list
+        Configurations to evaluate
+    directory: str
+        Where the golden files are
+    allow_stale: bool
+        See load_golden
+    Output
+    ------
+    results: list
+        One dict per candidate with its name, wall time in seconds, steps
+        per second, the worst error of each metric over all scenarios and
+        max_error, the worst of them all
+    """
+    golden = load_golden(directory, allow_stale)
+    states = scenarios()
+    results = []
+    for config in candidates:
+        wall_time = 0
+        steps = 0
+        worst = {}
+        for name, state in states.items():
+            time = golden[name]['time'][-1] - state['time']
+            start = timer.perf_counter()
+            trajectory = _run(state, time, config)
+            wall_time += timer.perf_counter() - start
+            steps += len(trajectory['time'])
+            for k, v in errors(golden[name], trajectory).items():
+                worst[k] = max(worst.get(k, 0), v)
+        result = {'name': config['name'], 'wall_time': wall_time,
+                  'steps_per_second': steps / wall_time, **worst}
+        result['max_error'] = max(v for k, v in worst.items()
+                                  if k.endswith('_max'))
+        results.append(result)
+    mark_pareto(results)
+    return(results)
+
+
+def mark_pareto(results: list) -> None:
+    """Mark results not beaten on both wall time and max_error"""
+    for r in results:
+        r['pareto'] = not any(
+            o['wall_time'] <= r['wall_time']
+            and o['max_error'] <= r['max_error']
+            and (o['wall_time'] < r['wall_time']
+                 or o['max_error'] < r['max_error'])
+            for o in results)
+
+
+def pareto_table(results: list) -> str:
+    """Results of evaluate as a text table sorted by wall time"""
+    columns = ['wall_time', 'steps_per_second', 'max_error'] + \
+        [f'{k}_max' for k in METRICS]
+    width = max(len(r['name']) for r in results) + 2
+    lines = ['name'.ljust(width) + ''.join(f'{c:>18}' for c in columns)
+             + '  pareto']
+    for r in sorted(results, key=lambda r: r['wall_time']):
+        cells = ''.join(f'{r[c]:>18.4g}' for c in columns)
+        lines.append(r['name'].ljust(width) + cells
+                     + ('  *' if r['pareto'] else ''))
+    return('\n'.join(lines))
+
+
+def fastest_within(results: list, tolerance: float) -> dict:
+    """Fastest result with max_error within a tolerance, None if none is"""
+    within = [r for r in results if r['max_error'] <= tolerance]
+    if not within:
+        return(None)
+    return(min(within, key=lambda r: r['wall_time']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['generate', 'evaluate'])
+    parser.add_argument('--days', type=float, default=1,
+                        help='length of the golden trajectories')
+    parser.add_argument('--directory', default=DEFAULT_DIRECTORY)
+    parser.add_argument('--tolerance', type=float, default=1e-2,
+                        help='largest acceptable relative error')
+    parser.add_argument('--allow-stale', action='store_true',
+                        help='evaluate against golden files of a changed '
+                             'model')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate_golden(args.days * ureg.day, args.directory)
+    else:
+        results = evaluate(CANDIDATES, args.directory, args.allow_stale)
+        print(pareto_table(results))
+        best = fastest_within(results, args.tolerance)
+        if best is not None:
+            print(f'Fastest within {args.tolerance:g}: {best["name"]}')
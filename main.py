@@ -1,20 +1,37 @@
+import json
+
 import pint
 
 from parameters import ureg
 import state
-import integrated_model
+import runner
+
 
+def main(time: pint.Quantity, state: dict,
+         t_step: pint.Quantity = 60 * 15 * ureg.s) -> dict:
+    """Simulate the integrated model, see runner.py for batches of runs
 
-def main(time: pint.Quantity, state: dict):
-    model = integrated_model.MBRModel(state)
-    t = 0 * ureg.s
-    t_step = 60 * 15 * ureg.s
-    while t < time:
-        days = t.to('day').magnitude
-        print(f'\r{days:.3f} days                     ', end='')
-        state = model.step_model(t_step)
-        t += t_step
+    Parameters
+    ----------
+    time: pint.Quantity
+        Length of the simulation
+    state: dict
+        Starting state, see state.py
+    t_step: pint.Quantity
+        The time step
+    Output
+    ------
+    state: dict
+        The final state
+    """
+    scenario = {**runner.DEFAULT_SCENARIO, 'name': 'main', 'state': state,
+                'time': time, 't_step': t_step}
+    summary, state = runner.run_scenario(scenario)
+    del summary['state']
+    print(json.dumps(summary))
+    return(state)
 
 
 if __name__ == "__main__":
+    runner.configure_logging()
     main(7 * ureg.day, state.starting_state)
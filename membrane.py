@@ -1,10 +1,13 @@
 import pint
 
+import numpy as np
 from typing import Tuple
-from math import exp
 
 from parameters import *
 
+# Specific cake resistance (Janus, 2013 p.280)
+ALPHA_C = 1.12 * (ureg.m / ureg.kg)
+
 
 class Membrane:
     def air_scouring(self, v_sg: pint.Quantity, X_TSS: pint.Quantity,
@@ -32,7 +35,7 @@ class Membrane:
                           X_MLSS: pint.Quantity, X_TSS: pint.Quantity,
                           alpha_c: pint.Quantity
                           ) -> Tuple[pint.Quantity, pint.Quantity]:
-        R_dot_i = a * k_i * exp(b * J) * J * (S_UAP + S_BAP)
+        R_dot_i = a * k_i * np.exp(b * J) * J * (S_UAP + S_BAP)
         R_dot_r = alpha_c * (J * X_MLSS - m_rback)
         return(R_dot_i, R_dot_r)
 
@@ -65,7 +68,7 @@ class Membrane:
         # Model taken from (Janus, 2013) with parameters from p.193
         new_state['m_rback'] = back_transport_coefficient * state['X_MLSS']
         # new_state['alpha_c'] = alpha_c0 * (Delta_P / Delta_P_crit) ** 2
-        new_state['alpha_c'] = 1.12 * (ureg.m / ureg.kg)  # (Janus, 2013 p.280)
+        new_state['alpha_c'] = ALPHA_C
         return(new_state)
 
     def specific_cake_resistance(self, X_EPS: pint.Quantity,
@@ -89,6 +92,8 @@ class Membrane:
         new_state: dict
             Contains all updated state variables
         """
-        J = state['Q_out'] / (membrane_density * state['volume'])
+        # Design studies can override the membrane density in the state
+        density = state.get('membrane_density', membrane_density)
+        J = state['Q_out'] / (density * state['volume'])
         new_state = self.membrane_resistance(t_step, state, J)
         return(new_state)
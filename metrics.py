@@ -0,0 +1,173 @@
+"""Derived plant metrics
+
+All metrics are computed after a run as array expressions over a complete
+trajectory, a dict mapping state variable names to pint.Quantity arrays with
+time along the last axis (see stack_states). Ensembles of runs are stacked
+along a leading axis with stack_trajectories and go through the same
+functions unchanged.
+
+The effluent is the membrane permeate: particulates are fully retained and
+SMP is retained with the fraction f_M, everything else passes through.
+
+Methods
+-------
+stack_states -> dict
+    Turn a list of states into a trajectory
+stack_trajectories -> dict
+    Turn a list of equally long trajectories into an ensemble
+cod -> pint.Quantity
+    Total chemical oxygen demand
+smp -> pint.Quantity
+    Soluble microbial products
+total_nitrogen -> pint.Quantity
+    Total nitrogen
+effluent_cod, effluent_tkn, effluent_total_nitrogen, effluent_bod5
+    Permeate quality
+effluent_quality_index -> pint.Quantity
+    Effluent quality index (Copp, 2002)
+fouling_rate -> pint.Quantity
+    Time derivative of TMP or a membrane resistance
+"""
+import numpy as np
+import pint
+
+from parameters import ureg, i_XB, i_XEPS, i_XBAP, i_XP, f_M
+
+COD_COMPONENTS = ['S_S', 'S_I', 'X_S', 'X_H', 'X_A', 'X_P', 'X_I', 'X_EPS',
+                  'S_UAP', 'S_BAP']
+# Pollution unit weights of the effluent quality index (Copp, 2002)
+B_COD = 1
+B_TKN = 30
+B_NO = 10
+B_BOD5 = 2
+
+
+def stack_states(states: list, keys: list = None) -> dict:
+    """Stack a list of states into a trajectory
+
+    Parameters
+    ----------
+    states: list
+        States in time order, as returned by MBRModel.step_model
+    keys: list
+        State variables to keep, all pint.Quantity variables if None
+    Output
+    ------
+    trajectory: dict
+        One pint.Quantity array per state variable
+    """
+    if keys is None:
+        keys = [k for k, v in states[0].items()
+                if isinstance(v, pint.Quantity)]
+    trajectory = {}
+    for k in keys:
+        units = states[0][k].units
+        if all(s[k].units == units for s in states):
+            values = [s[k].magnitude for s in states]
+        else:
+            values = [s[k].m_as(units) for s in states]
+        trajectory[k] = ureg.Quantity(np.array(values, dtype=float), units)
+    return(trajectory)
+
+
+def stack_trajectories(trajectories: list) -> dict:
+    """Stack equally long trajectories into an ensemble
+
+    Output
+    ------
+    ensemble: dict
+        One pint.Quantity array per state variable with runs along the
+        first axis and time along the last
+    """
+    ensemble = {}
+    for k, v in trajectories[0].items():
+        values = [t[k].m_as(v.units) for t in trajectories]
+        ensemble[k] = ureg.Quantity(np.stack(values), v.units)
+    return(ensemble)
+
+
+def cod(trajectory: dict) -> pint.Quantity:
+    """Total COD of all soluble and particulate components"""
+    return(sum(trajectory[k] for k in COD_COMPONENTS))
+
+
+def smp(trajectory: dict) -> pint.Quantity:
+    """Soluble microbial products, S_SMP = S_UAP + S_BAP"""
+    return(trajectory['S_UAP'] + trajectory['S_BAP'])
+
+
+def total_nitrogen(trajectory: dict) -> pint.Quantity:
+    """Total nitrogen including nitrogen bound in biomass and products"""
+    t = trajectory
+    N = (i_XB * t['X_H'] + i_XEPS * t['X_EPS'] + i_XBAP * t['S_BAP']
+         + i_XB * t['X_A'] + i_XP * t['X_P'] + t['S_NO'] + t['S_N2']
+         + t['S_NH'] + t['S_ND'] + t['X_ND'])
+    return(N)
+
+
+def effluent_cod(trajectory: dict) -> pint.Quantity:
+    """COD of the permeate"""
+    t = trajectory
+    return(t['S_I'] + t['S_S'] + (1 - f_M) * smp(t))
+
+
+def effluent_tkn(trajectory: dict) -> pint.Quantity:
+    """Kjeldahl nitrogen of the permeate"""
+    t = trajectory
+    return(t['S_NH'] + t['S_ND'] + (1 - f_M) * i_XBAP * t['S_BAP'])
+
+
+def effluent_total_nitrogen(trajectory: dict) -> pint.Quantity:
+    """Total nitrogen of the permeate"""
+    return(effluent_tkn(trajectory) + trajectory['S_NO'])
+
+
+def effluent_bod5(trajectory: dict) -> pint.Quantity:
+    """Five day BOD of the permeate (Copp, 2002)"""
+    return(0.25 * trajectory['S_S'])
+
+
+def effluent_quality_index(trajectory: dict) -> pint.Quantity:
+    """Effluent quality index (Copp, 2002)
+
+    The flow weighted pollution load of the permeate averaged over the
+    trajectory. The permeate carries no suspended solids.
+
+    Output
+    ------
+    EQI: pint.Quantity
+        Pollution load in kg of pollution units per day, one per run
+    """
+    t = trajectory
+    load = ((B_COD * effluent_cod(t) + B_TKN * effluent_tkn(t)
+             + B_NO * t['S_NO'] + B_BOD5 * effluent_bod5(t)) * t['Q_out'])
+    load = load.to(ureg.kg / ureg.day).magnitude
+    time = t['time'].to(ureg.day).magnitude
+    if time.shape[-1] < 2:
+        return(load[..., -1] * (ureg.kg / ureg.day))
+    duration = time[..., -1] - time[..., 0]
+    mean_load = 0.5 * (load[..., 1:] + load[..., :-1])
+    EQI = np.sum(mean_load * np.diff(time, axis=-1), axis=-1) / duration
+    return(EQI * (ureg.kg / ureg.day))
+
+
+def fouling_rate(trajectory: dict, key: str = 'TMP') -> pint.Quantity:
+    """Rate of change of TMP or a membrane resistance
+
+    Parameters
+    ----------
+    trajectory: dict
+        See stack_states
+    key: str
+        TMP, R_t, R_i or R_r
+    Output
+    ------
+    rate: pint.Quantity
+        Time derivative at every point of the trajectory
+    """
+    y = trajectory[key].to_base_units()
+    time = trajectory['time'].to_base_units()
+    # Runs of an ensemble share their time points
+    t = time.magnitude.reshape(-1, time.shape[-1])[0]
+    rate = np.gradient(y.magnitude, t, axis=-1)
+    return(rate * (y.units / time.units))
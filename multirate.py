@@ -0,0 +1,290 @@
+"""Multirate operator-splitting integrator
+
+The biology (S_O and S_S change over minutes to hours) and membrane fouling
+(R_i builds up over weeks) evolve on very different timescales. The
+MultirateModel advances the membrane with large macro steps while the
+bioreactor kinetics inside each macro step are either sub-cycled with small
+explicit steps or integrated implicitly (BDF). The membrane then sees the
+time-averaged SMP and MLSS concentrations of the macro step.
+
+The biology is integrated on plain arrays with a kernel generated from a
+process_table model definition, so the cost per step does not include any
+pint arithmetic, and the implicit integration uses its analytic Jacobian.
+Accuracy is controlled against the monolithic solve (MBRModel.step_model)
+with compare and choose_macro_step.
+
+Classes
+-------
+MultirateModel
+    Drop-in replacement for MBRModel with multirate stepping
+
+Methods
+-------
+compare -> dict
+    Errors of a multirate run relative to the monolithic solve
+choose_macro_step -> pint.Quantity
+    Largest macro step within a tolerance of the monolithic solve
+"""
+import math
+
+import numpy as np
+import pint
+from scipy.integrate import solve_ivp
+
+import integrated_model
+import process_table
+import simulation
+import sludge
+from parameters import ureg
+
+# Variables integrated by the biology of the default model definition,
+# X_MLSS takes part in no reactions
+BIOLOGY_KEYS = sludge.MATRIX_COMPONENTS + ['X_MLSS']
+# Variables the membrane sees as averages over a macro step
+AVERAGED_KEYS = ['S_UAP', 'S_BAP', 'X_MLSS']
+TSS_KEYS = ['X_S', 'X_H', 'X_A', 'X_P', 'X_I', 'X_EPS']
+# Variables checked against the monolithic solve
+COMPARED_KEYS = ['S_O', 'S_S', 'S_NH', 'S_NO', 'X_EPS', 'S_UAP', 'S_BAP',
+                 'X_MLSS', 'R_t', 'TMP']
+
+
+def pack(state: dict, keys: list) -> np.ndarray:
+    """State variables as an array of base unit magnitudes"""
+    return(np.array([state[k].to_base_units().magnitude for k in keys]))
+
+
+def unpack(values: np.ndarray, keys: list, state: dict) -> dict:
+    """Write base unit magnitudes back into a copy of a state
+
+    Every variable keeps the units it has in state.
+    """
+    new_state = state.copy()
+    for k, v in zip(keys, values):
+        base = state[k].to_base_units().units
+        new_state[k] = ureg.Quantity(v, base).to(state[k].units)
+    return(new_state)
+
+
+class MultirateModel(integrated_model.MBRModel):
+    def __init__(self, state: dict,
+                 substep: pint.Quantity = 60 * 5 * ureg.s,
+                 method: str = 'euler', rtol: float = 1e-6,
+                 atol: float = 1e-10, table: dict = None) -> None:
+        """Integrated model with multirate stepping
+
+        Parameters
+        ----------
+        state: dict
+            See state.py file for all required state variables
+        substep: pint.Quantity
+            Largest biology step when method is 'euler'
+        method: str
+            'euler' to sub-cycle the biology with explicit steps like
+            Bioreactor.step or 'bdf' to integrate it implicitly
+        rtol: float
+            Relative tolerance of the implicit integration
+        atol: float
+            Absolute tolerance of the implicit integration in kg/m^3
+        table: dict
+            Model definition of the biology, process_table.PROCESS_TABLE if
+            None. The state needs every component and its influent value.
+        """
+        super().__init__(state)
+        self.substep = substep.to(ureg.s).magnitude
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+        if table is None:
+            table = process_table.PROCESS_TABLE
+        self.kernel = process_table.compile_table(table)
+        self.biology_keys = list(self.kernel.COMPONENTS) + ['X_MLSS']
+        self._averaged = [self.biology_keys.index(k) for k in AVERAGED_KEYS]
+        self._tss = [self.biology_keys.index(k) for k in TSS_KEYS]
+
+    def step_model(self, t_step: pint.Quantity) -> dict:
+        """Step the integrated model forward by one macro step
+
+        Parameters
+        ----------
+        t_step: pint.Quantity
+            The macro step
+        """
+        bio_state, averages = self.step_biology(t_step)
+        # The membrane advances once over the whole macro step
+        membrane_state = bio_state.copy()
+        membrane_state.update(averages)
+        new_state = self.membrane.step(t_step, membrane_state)
+        for k in AVERAGED_KEYS:
+            new_state[k] = bio_state[k]
+        new_state['time'] = self.state['time'] + t_step
+        self.state = new_state
+        return(self.state)
+
+    def step_biology(self, t_step: pint.Quantity) -> tuple:
+        """Integrate the bioreactor over a macro step
+
+        Parameters
+        ----------
+        t_step: pint.Quantity
+            The macro step
+        Output
+        ------
+        new_state: dict
+            State at the end of the macro step
+        averages: dict
+            Time averages of AVERAGED_KEYS over the macro step
+        """
+        state = self.state
+        keys = self.biology_keys
+        C = pack(state, keys)
+        C_in = pack(state, [f'in_{k}' for k in keys])
+        V = state['volume'].to(ureg.m ** 3).magnitude
+        Q_in = state['Q_in'].to(ureg.m ** 3 / ureg.s).magnitude
+        Q_out = state['Q_out'].to(ureg.m ** 3 / ureg.s).magnitude
+        T = state['temperature'].to(ureg.degC).magnitude
+        H = t_step.to(ureg.s).magnitude
+
+        if self.method == 'euler':
+            C, V, integrals = self._subcycle(C, C_in, V, Q_in, Q_out, T, H)
+        elif self.method == 'bdf':
+            C, V, integrals = self._implicit(C, C_in, V, Q_in, Q_out, T, H)
+        else:
+            raise ValueError(f'Unknown method {self.method!r}')
+
+        new_state = unpack(C, keys, state)
+        new_state['volume'] = V * ureg.m ** 3
+        X_TSS = 0.75 * np.sum(C[self._tss])
+        new_state['X_TSS'] = ureg.Quantity(
+            X_TSS, ureg.kg / ureg.m ** 3).to(state['X_TSS'].units)
+        averages = unpack(integrals / H, AVERAGED_KEYS, state)
+        averages = {k: averages[k] for k in AVERAGED_KEYS}
+        return(new_state, averages)
+
+    def _reaction_rates(self, C: np.ndarray, T: float) -> np.ndarray:
+        rates = np.zeros_like(C)
+        rates[:-1] = self.kernel.reaction_rates(C[:-1], T)
+        return(rates)
+
+    def _subcycle(self, C, C_in, V, Q_in, Q_out, T, H):
+        # Same update as Bioreactor.material_balance on plain arrays
+        n = max(math.ceil(H / self.substep - 1e-9), 1)
+        h = H / n
+        integrals = np.zeros(len(AVERAGED_KEYS))
+        for _ in range(n):
+            r = self._reaction_rates(C, T)
+            m_total = C * V + (Q_in * C_in - Q_out * C + r * V) * h
+            C = np.maximum(m_total, 0) / V
+            V = V + (Q_in - Q_out) * h
+            integrals += C[self._averaged] * h
+        return(C, V, integrals)
+
+    def _implicit(self, C, C_in, V, Q_in, Q_out, T, H):
+        n = len(C)
+
+        def rhs(t, y):
+            C = np.maximum(y[:n], 0)
+            V = y[n]
+            dC = Q_in * (C_in - C) / V + self._reaction_rates(C, T)
+            return(np.concatenate([dC, [Q_in - Q_out], C[self._averaged]]))
+
+        def jacobian(t, y):
+            C = np.maximum(y[:n], 0)
+            V = y[n]
+            J = np.zeros((len(y), len(y)))
+            J[:n - 1, :n - 1] = self.kernel.jacobian(C[:-1], T)
+            J[:n, :n] -= np.eye(n) * Q_in / V
+            J[:n, n] = -Q_in * (C_in - C) / V ** 2
+            J[n + 1 + np.arange(len(self._averaged)), self._averaged] = 1
+            return(J)
+
+        y0 = np.concatenate([C, [V], np.zeros(len(AVERAGED_KEYS))])
+        solution = solve_ivp(rhs, (0, H), y0, method='BDF', rtol=self.rtol,
+                             atol=self.atol, jac=jacobian)
+        if not solution.success:
+            raise RuntimeError(solution.message)
+        y = solution.y[:, -1]
+        return(np.maximum(y[:n], 0), y[n], y[n + 1:])
+
+
+def compare(state: dict, time: pint.Quantity, t_step: pint.Quantity,
+            macro_step: pint.Quantity, reference: dict = None,
+            **options) -> dict:
+    """Errors of a multirate run relative to the monolithic solve
+
+    Parameters
+    ----------
+    state: dict
+        Starting state
+    time: pint.Quantity
+        Length of the comparison
+    t_step: pint.Quantity
+        Time step of the monolithic solve
+    macro_step: pint.Quantity
+        Macro step of the multirate run, a multiple of t_step
+    reference: dict
+        Monolithic trajectory if already computed, see simulation.run
+    options:
+        Passed on to MultirateModel
+    Output
+    ------
+    errors: dict
+        Largest error of each of COMPARED_KEYS relative to the largest
+        magnitude it reaches in the monolithic solve
+    """
+    if reference is None:
+        reference = simulation.run(state, time, t_step)
+    trajectory = simulation.run(state, time, macro_step,
+                                integrator='multirate', **options)
+    t_ref = reference['time'].to(ureg.s).magnitude
+    t_mr = trajectory['time'].to(ureg.s).magnitude
+    index = np.searchsorted(t_ref, t_mr)
+    keep = (index < len(t_ref))
+    keep[keep] = np.isclose(t_ref[index[keep]], t_mr[keep])
+    errors = {}
+    for k in COMPARED_KEYS:
+        units = reference[k].units
+        y_ref = reference[k].magnitude
+        y_mr = trajectory[k].to(units).magnitude
+        scale = np.max(np.abs(y_ref))
+        error = np.max(np.abs(y_mr[keep] - y_ref[index[keep]]), initial=0)
+        errors[k] = error / scale if scale > 0 else error
+    return(errors)
+
+
+def choose_macro_step(state: dict, t_step: pint.Quantity,
+                      tolerance: float = 1e-3,
+                      probe_time: pint.Quantity = 1 * ureg.day,
+                      max_ratio: int = 256, **options) -> pint.Quantity:
+    """Largest macro step that stays within a tolerance of the monolithic
+    solve over a probe window
+
+    Parameters
+    ----------
+    state: dict
+        Starting state
+    t_step: pint.Quantity
+        Time step of the monolithic solve
+    tolerance: float
+        Largest allowed relative error, see compare
+    probe_time: pint.Quantity
+        Length of the probe window
+    max_ratio: int
+        Largest ratio of macro step to t_step tried
+    options:
+        Passed on to MultirateModel
+    Output
+    ------
+    macro_step: pint.Quantity
+        A power of two multiple of t_step
+    """
+    reference = simulation.run(state, probe_time, t_step)
+    macro_step = t_step
+    ratio = 2
+    while ratio <= max_ratio and ratio * t_step <= probe_time:
+        errors = compare(state, probe_time, t_step, ratio * t_step,
+                         reference, **options)
+        if max(errors.values()) > tolerance:
+            break
+        macro_step = ratio * t_step
+        ratio *= 2
+    return(macro_step)
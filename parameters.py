@@ -7,6 +7,8 @@ import pint
 
 ureg = pint.UnitRegistry()
 ureg.load_definitions('custom_units.txt')
+# Quantities sent to worker processes are unpickled with this registry
+pint.set_application_registry(ureg)
 
 # Yield coefficient for heterotrophic growth on S_UAP and S_BAP
 Y_SMP = 0.45 * (ureg.gCOD / ureg.gCOD)
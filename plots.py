@@ -13,10 +13,13 @@ Varied Values:
 - Oxygen concentration = [0, 1, 4.5] mg/L
 - Temperature = [5, 20, 30] C
 """
+import concurrent.futures
+import matplotlib
 import matplotlib.pyplot as plt
-from parameters import ureg, i_XB, i_XEPS, i_XBAP, i_XP
+from parameters import ureg
 from state import starting_state
-import integrated_model
+import cache
+import metrics
 import pint
 
 # Defining units for shorthand
@@ -26,37 +29,61 @@ C = ureg.degC
 day = ureg.day
 
 
-def make_plots(data: list, fsz: int = 10) -> None:
-    ylabels = ['COD (mg/L)', '$S_{SMP}$ (mg/L)', '$X_{EPS}$ (mg/L)',
-               'Total Nitrogen (mg/L)', 'Membrane Resistance (1/m)',
-               'TMP (kPa)']
-    dict_keys = ['COD (mg/L)', 'S_SMP (mg/L)', 'X_EPS (mg/L)', 'N (mg/L)',
-                 'R_t (1/m)', 'TMP (kPa)']
-    file_names = ['COD.png', 'SMP.png', 'EPS.png', 'Nitrogen.png',
-                  'Resistance.png', 'TMP.png']
-
-    for i in range(len(dict_keys)):
-        fig, ax = plt.subplots(nrows=1, ncols=1)
-        for data_set in data:
-            x_mlss = data_set['X_MLSS (g/L)']
-            s_o = data_set['S_O,in (mg/L)']
-            temperature = data_set['T (C)']
-            data_label = ("$X_{MLSS} = %.1f g/L | " %x_mlss
-                          + "S_{O,in} = %.1f mg/L | " %s_o
-                          + "T = %.1f C$" %temperature)
-            x_data = data_set['t (day)']
-            y_data = data_set[dict_keys[i]]
-            ax.plot(x_data, y_data, label=data_label)
-        ax.set_xlabel('Time (day)', fontsize=fsz)
-        ax.set_ylabel(ylabels[i], fontsize=fsz)
-        ax.legend(fontsize=fsz)
-        fig.set_size_inches(8, 6)
-        fig.set_tight_layout(True)
-        plt.savefig(f'plots/{file_names[i]}')
-
-
-def generate_data(time: pint.Quantity = 1 * day) -> None:
-    time = time.to(day)
+PLOT_YLABELS = ['COD (mg/L)', '$S_{SMP}$ (mg/L)', '$X_{EPS}$ (mg/L)',
+                'Total Nitrogen (mg/L)', 'Membrane Resistance (1/m)',
+                'TMP (kPa)']
+PLOT_KEYS = ['COD (mg/L)', 'S_SMP (mg/L)', 'X_EPS (mg/L)', 'N (mg/L)',
+             'R_t (1/m)', 'TMP (kPa)']
+PLOT_FILES = ['COD.png', 'SMP.png', 'EPS.png', 'Nitrogen.png',
+              'Resistance.png', 'TMP.png']
+
+
+def make_plots(data: list, fsz: int = 10, workers: int = None) -> None:
+    """Render every figure in its own worker process
+
+    Parameters
+    ----------
+    data: list
+        One dict per simulation, see trajectory_data
+    fsz: int
+        Font size
+    workers: int
+        Number of worker processes, one per figure if None
+    """
+    if workers is None:
+        workers = len(PLOT_KEYS)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        figures = [executor.submit(make_plot, i, data, fsz)
+                   for i in range(len(PLOT_KEYS))]
+        for figure in figures:
+            figure.result()
+
+
+def make_plot(i: int, data: list, fsz: int = 10) -> None:
+    """Render the i-th figure of PLOT_KEYS for all simulations"""
+    matplotlib.use('Agg')
+    fig, ax = plt.subplots(nrows=1, ncols=1)
+    for data_set in data:
+        x_mlss = data_set['X_MLSS (g/L)']
+        s_o = data_set['S_O,in (mg/L)']
+        temperature = data_set['T (C)']
+        data_label = ("$X_{MLSS} = %.1f g/L | " %x_mlss
+                      + "S_{O,in} = %.1f mg/L | " %s_o
+                      + "T = %.1f C$" %temperature)
+        x_data = data_set['t (day)']
+        y_data = data_set[PLOT_KEYS[i]]
+        ax.plot(x_data, y_data, label=data_label)
+    ax.set_xlabel('Time (day)', fontsize=fsz)
+    ax.set_ylabel(PLOT_YLABELS[i], fontsize=fsz)
+    ax.legend(fontsize=fsz)
+    fig.set_size_inches(8, 6)
+    fig.set_tight_layout(True)
+    fig.savefig(f'plots/{PLOT_FILES[i]}')
+    plt.close(fig)
+
+
+def scenarios() -> list:
+    """Starting states of the simulated scenarios"""
     # The parameters to vary
     X_MLSS = [3 * gL, 15 * gL, 30 * gL]
     oxygen = [0 * mgL, 1 * mgL, 4.5 * mgL]
@@ -70,61 +97,61 @@ def generate_data(time: pint.Quantity = 1 * day) -> None:
                   (X_MLSS[1], oxygen[2], temperature[1]),
                   (X_MLSS[1], oxygen[1], temperature[0]),
                   (X_MLSS[1], oxygen[1], temperature[2]))
-    n_sims = len(parameters)
-    all_data = []
-    for i, (x_m, s_o, T) in enumerate(parameters):
-        # Generate a new starting state
+    states = []
+    for x_m, s_o, T in parameters:
         state = starting_state.copy()
         state['X_MLSS'] = x_m
         state['in_X_MLSS'] = x_m
         state['in_S_O'] = s_o
         state['temperature'] = T
-        # Create a new model and reset timer
-        model = integrated_model.MBRModel(state)
-        t = 0 * ureg.s
-        t_step = 60 * 5 * ureg.s
-        data = {
-            't (day)': [],
-            'COD (mg/L)': [],
-            'S_SMP (mg/L)': [],
-            'X_EPS (mg/L)': [],
-            'N (mg/L)': [],
-            'R_t (1/m)': [],
-            'TMP (kPa)': [],
-            'X_MLSS (g/L)': x_m.to(gL).magnitude,
-            'S_O,in (mg/L)': s_o.to(mgL).magnitude,
-            'T (C)': T.to(C).magnitude
-        }
-        while t < time:
-            # Simulate model
+        states.append(state)
+    return(states)
+
+
+def generate_data(time: pint.Quantity = 1 * day,
+                  result_cache: cache.ResultCache = None) -> None:
+    """Simulate all scenarios and plot the results
+
+    Parameters
+    ----------
+    time: pint.Quantity
+        Length of each simulation
+    result_cache: cache.ResultCache
+        Where unchanged scenarios are fetched from instead of being
+        recomputed, a cache in the default directory is used if None
+    """
+    time = time.to(day)
+    if result_cache is None:
+        result_cache = cache.ResultCache()
+    t_step = 60 * 5 * ureg.s
+    states = scenarios()
+    n_sims = len(states)
+    all_data = []
+    for i, state in enumerate(states):
+        def progress(t):
             days = t.to('day').magnitude
             print(f'\rSimulation {i+1}/{n_sims}| {days:.3f}/{time:.3f} days  ',
                   end='')
-            state = model.step_model(t_step)
-            data = update_data(data, state)
-            t += t_step
+        trajectory = result_cache.run(state, time, t_step, progress)
+        data = trajectory_data(trajectory)
+        data['X_MLSS (g/L)'] = state['X_MLSS'].to(gL).magnitude
+        data['S_O,in (mg/L)'] = state['in_S_O'].to(mgL).magnitude
+        data['T (C)'] = state['temperature'].to(C).magnitude
         all_data.append(data)
     make_plots(all_data)
 
 
-def update_data(data: dict, state: dict) -> dict:
-    data['t (day)'].append(state['time'].to(day).magnitude)
-    data['R_t (1/m)'].append(state['R_t'].to(ureg.m ** -1).magnitude)
-    data['TMP (kPa)'].append(state['TMP'].to(ureg.kPa).magnitude)
-    data['X_EPS (mg/L)'].append(state['X_EPS'].to(mgL).magnitude)
-
-    COD = (state['S_S'] + state['S_I'] +  state['X_S'] + state['X_H']
-           + state['X_A'] + state['X_P'] + state['X_I'] + state['X_EPS']
-           + state['S_UAP'] + state['S_BAP'])
-    S_SMP = state['S_BAP'] + state['S_UAP']
-    N = (i_XB * state['X_H'] + i_XEPS * state['X_EPS']
-         + i_XBAP * state['S_BAP'] + i_XB * state['X_A'] + i_XP * state['X_P']
-         + state['S_NO'] + state['S_N2'] + state['S_NH'] + state['S_ND']
-         + state['X_ND'])
-
-    data['COD (mg/L)'].append(COD.to(mgL).magnitude)
-    data['S_SMP (mg/L)'].append(S_SMP.to(mgL).magnitude)
-    data['N (mg/L)'].append(N.to(mgL).magnitude)
+def trajectory_data(trajectory: dict) -> dict:
+    """Plotted values of a whole trajectory, see metrics.stack_states"""
+    data = {
+        't (day)': trajectory['time'].to(day).magnitude,
+        'COD (mg/L)': metrics.cod(trajectory).to(mgL).magnitude,
+        'S_SMP (mg/L)': metrics.smp(trajectory).to(mgL).magnitude,
+        'X_EPS (mg/L)': trajectory['X_EPS'].to(mgL).magnitude,
+        'N (mg/L)': metrics.total_nitrogen(trajectory).to(mgL).magnitude,
+        'R_t (1/m)': trajectory['R_t'].to(ureg.m ** -1).magnitude,
+        'TMP (kPa)': trajectory['TMP'].to(ureg.kPa).magnitude,
+    }
     return(data)
 
 
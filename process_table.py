@@ -0,0 +1,460 @@
+"""Declarative activated sludge model definition and generated rate kernels
+
+The model is written as data: the components, and for every process its rate
+expression and its stoichiometric coefficients. Rate expressions use the
+component names, T (temperature in degrees Celsius), exp and any parameter
+from parameters.py; stoichiometric coefficients are expressions of
+parameters only. All values are taken in base SI units.
+
+compile_table generates a Python module from a definition with
+
+- process_rates(C, T), every process rate,
+- reaction_rates(C, T), the net reaction rate of every component,
+- jacobian(C, T), the analytic derivatives of reaction_rates with only the
+  non-zero entries of the Petersen matrix folded in,
+
+all working on arrays with components along the first axis and any number of
+batch axes. Generated modules are stored on disk under a hash of the
+definition and the parameter values, so each variant is only generated once,
+and every newly generated jacobian is checked against finite differences
+of reaction_rates before it is stored.
+
+PROCESS_TABLE is the only definition of the rate model: Bioreactor,
+MultirateModel, the controller and the design optimizer all use its kernel.
+
+A model variant, e.g. with an extra EPS formation pathway, is a copy of
+PROCESS_TABLE with processes added or changed (see add_process).
+
+Classes
+-------
+Kernel
+    Generated kernel of a model definition
+
+Methods
+-------
+compile_table -> Kernel
+    Generate (or load) the kernel of a model definition
+default_kernel -> Kernel
+    Kernel of PROCESS_TABLE
+check_jacobian -> float
+    Error of a kernel's jacobian against finite differences
+add_process -> dict
+    Copy of a model definition with another process
+"""
+import ast
+import copy
+import functools
+import hashlib
+import importlib.util
+import json
+import os
+
+import numpy as np
+import pint
+
+import parameters
+
+PROCESS_TABLE = {
+    'components': ['S_I', 'S_S', 'X_I', 'X_S', 'X_H', 'X_EPS', 'S_UAP',
+                   'S_BAP', 'X_A', 'X_P', 'S_O', 'S_NO', 'S_N2', 'S_NH',
+                   'S_ND', 'X_ND', 'S_ALK'],
+    'processes': [
+        {'name': 'p1', 'description': 'Ammonification',
+         'rate': 'k_a * S_ND * X_H',
+         'stoichiometry': {'S_NH': '1', 'S_ND': '-1', 'S_ALK': '1 / 14'}},
+        {'name': 'p2a', 'description': 'Aerobic growth on S_S',
+         'rate': ('mu_H * S_S / (K_S + S_S) * S_O / (K_OH + S_O) * X_H'),
+         'stoichiometry': {'S_S': '-1 / Y_H', 'X_H': '1 - f_EPSh',
+                           'X_EPS': 'f_EPSh', 'S_UAP': 'gamma_H / Y_H',
+                           'S_O': 'x2a', 'S_NH': 'y2a',
+                           'S_ALK': '-i_XB / 14'}},
+        {'name': 'p2b', 'description': 'Aerobic growth on S_BAP',
+         'rate': ('exp(-0.069 * (20 - T)) * mu_BAP * S_BAP / (K_BAP + S_BAP)'
+                  ' * S_O / (K_OH + S_O) * S_ALK / (K_ALKH + S_ALK) * X_H'),
+         'stoichiometry': {'X_H': '1 - f_EPSh', 'X_EPS': 'f_EPSh',
+                           'S_BAP': '-1 / Y_SMP', 'S_O': 'x2b',
+                           'S_NH': 'y2b', 'S_ALK': '-i_XB / 14'}},
+        {'name': 'p2c', 'description': 'Aerobic growth on S_UAP',
+         'rate': ('exp(-0.069 * (20 - T)) * mu_UAP * S_UAP / (K_UAP + S_UAP)'
+                  ' * S_O / (K_OH + S_O) * S_ALK / (K_ALKH + S_ALK) * X_H'),
+         'stoichiometry': {'X_H': '1 - f_EPSh', 'X_EPS': 'f_EPSh',
+                           'S_UAP': '-1 / Y_SMP', 'S_O': 'x2c',
+                           'S_NH': 'y2c', 'S_ALK': '-i_XB / 14'}},
+        {'name': 'p3a', 'description': 'Anoxic growth on S_S',
+         'rate': ('mu_H * eta_g * S_S / (K_S + S_S) * K_OH / (K_OH + S_O)'
+                  ' * S_NO / (K_NO + S_NO) * X_H'),
+         'stoichiometry': {'S_S': '-1 / Y_H', 'X_H': '1 - f_EPSh',
+                           'X_EPS': 'f_EPSh', 'S_UAP': 'gamma_H / Y_H',
+                           'S_NO': 'x3a', 'S_N2': '-x3a', 'S_NH': 'y3a',
+                           'S_ALK': '(1 - Y_H) / (40 * Y_H) - i_XB / 14'}},
+        {'name': 'p3b', 'description': 'Anoxic growth on S_BAP',
+         'rate': ('exp(-0.069 * (20 - T)) * mu_BAP * eta_g'
+                  ' * S_BAP / (K_BAP + S_BAP) * K_OH / (K_OH + S_O)'
+                  ' * S_NO / (K_NO + S_NO) * S_ALK / (K_ALKH + S_ALK) * X_H'),
+         'stoichiometry': {'X_H': '1 - f_EPSh', 'X_EPS': 'f_EPSh',
+                           'S_BAP': '-1 / Y_SMP', 'S_NO': 'x3b',
+                           'S_N2': '-x3b', 'S_NH': 'y3b',
+                           'S_ALK': '(1 - Y_H) / (40 * Y_H) - i_XB / 14'}},
+        {'name': 'p3c', 'description': 'Anoxic growth on S_UAP',
+         'rate': ('exp(-0.069 * (20 - T)) * mu_UAP * eta_g'
+                  ' * S_UAP / (K_UAP + S_UAP) * K_OH / (K_OH + S_O)'
+                  ' * S_NO / (K_NO + S_NO) * S_ALK / (K_ALKH + S_ALK) * X_H'),
+         'stoichiometry': {'X_H': '1 - f_EPSh', 'X_EPS': 'f_EPSh',
+                           'S_UAP': '-1 / Y_SMP', 'S_NO': 'x3c',
+                           'S_N2': '-x3c', 'S_NH': 'y3c',
+                           'S_ALK': '(1 - Y_H) / (40 * Y_H) - i_XB / 14'}},
+        {'name': 'p4', 'description': 'Decay of heterotrophs',
+         'rate': 'b_H * X_H',
+         'stoichiometry': {'X_S': '1 - f_P - f_EPSdh - f_BAP', 'X_H': '-1',
+                           'X_EPS': 'f_EPSdh', 'S_BAP': 'f_BAP',
+                           'X_P': 'f_P', 'X_ND': 'i_XP - f_P * i_XP'}},
+        # K_X + X_S / X_H rearranged so the rate stays finite without
+        # heterotrophs
+        {'name': 'p5', 'description': 'Hydrolysis of organic compounds',
+         'rate': ('k_h * X_S * X_H / (K_X * X_H + X_S)'
+                  ' * (S_O / (K_OH + S_O) + eta_h * K_OH / (K_OH + S_O)'
+                  ' * S_NO / (K_NO + S_NO))'),
+         'stoichiometry': {'S_S': '1', 'X_S': '-1'}},
+        # p5 * X_ND / X_S
+        {'name': 'p6', 'description': 'Hydrolysis of organic Nitrogen',
+         'rate': ('k_h * X_ND * X_H / (K_X * X_H + X_S)'
+                  ' * (S_O / (K_OH + S_O) + eta_h * K_OH / (K_OH + S_O)'
+                  ' * S_NO / (K_NO + S_NO))'),
+         'stoichiometry': {'S_ND': '1', 'X_ND': '-1'}},
+        {'name': 'p7', 'description': 'Hydrolysis of X_EPS',
+         'rate': 'exp(-0.11 * (20 - T)) * k_hEPS * X_EPS',
+         'stoichiometry': {'S_S': 'f_S', 'X_EPS': '-1', 'S_UAP': '1 - f_S',
+                           'S_ND': 'i_XEPS - i_XBAP * (1 - f_S)'}},
+        {'name': 'p8', 'description': 'Aerobic growth of autotrophs',
+         'rate': 'mu_A * S_NH / (K_NH + S_NH) * S_O / (K_OA + S_O) * X_A',
+         'stoichiometry': {'X_EPS': 'f_EPSa', 'S_UAP': 'gamma_A / Y_A',
+                           'X_A': '1 - f_EPSa',
+                           'S_O': '-(64 / 14 - Y_A) / Y_A',
+                           'S_NO': '1 / Y_A', 'S_NH': '-i_XB - 1 / Y_A',
+                           'S_ALK': '-i_XB / 14 - 1 / (7 * Y_A)'}},
+        {'name': 'p9', 'description': 'Decay of autotrophs',
+         'rate': 'b_A * X_A',
+         'stoichiometry': {'X_S': '1 - f_P - f_EPSda - f_BAP',
+                           'X_EPS': 'f_EPSda', 'S_BAP': 'f_BAP',
+                           'X_A': '-1', 'X_P': 'f_P',
+                           'X_ND': 'i_XP - f_P * i_XP'}},
+    ],
+}
+DEFAULT_DIRECTORY = os.path.join('.cache', 'kernels')
+# Largest relative error of a generated jacobian against finite differences
+JACOBIAN_TOLERANCE = 1e-5
+
+
+def add_process(table: dict, process: dict) -> dict:
+    """Copy of a model definition with another process
+
+    Parameters
+    ----------
+    table: dict
+        Model definition, see PROCESS_TABLE
+    process: dict
+        Process with a name, a rate and stoichiometry
+    """
+    table = copy.deepcopy(table)
+    table['processes'].append(copy.deepcopy(process))
+    return(table)
+
+
+def parameter_values() -> dict:
+    """Base unit magnitudes of all numeric parameters in parameters.py"""
+    values = {}
+    for k, v in vars(parameters).items():
+        if k.startswith('_'):
+            continue
+        if isinstance(v, pint.Quantity):
+            values[k] = float(v.to_base_units().magnitude)
+        elif isinstance(v, (int, float)):
+            values[k] = float(v)
+    return(values)
+
+
+def stoichiometry(table: dict) -> np.ndarray:
+    """Petersen matrix of a model definition
+
+    Output
+    ------
+    m: np.ndarray
+        Stoichiometric coefficients with processes along the rows and
+        components along the columns
+    """
+    values = parameter_values()
+    components = table['components']
+    m = np.zeros((len(table['processes']), len(components)))
+    for i, process in enumerate(table['processes']):
+        for k, expression in process['stoichiometry'].items():
+            m[i, components.index(k)] = eval(expression, {}, dict(values))
+    return(m)
+
+
+# Symbolic differentiation of rate expressions
+def _is_constant(node: ast.AST, value: float) -> bool:
+    return(isinstance(node, ast.Constant) and node.value == value)
+
+
+def _add(a: ast.AST, b: ast.AST) -> ast.AST:
+    if _is_constant(a, 0):
+        return(b)
+    if _is_constant(b, 0):
+        return(a)
+    return(ast.BinOp(a, ast.Add(), b))
+
+
+def _sub(a: ast.AST, b: ast.AST) -> ast.AST:
+    if _is_constant(b, 0):
+        return(a)
+    if _is_constant(a, 0):
+        return(ast.UnaryOp(ast.USub(), b))
+    return(ast.BinOp(a, ast.Sub(), b))
+
+
+def _mul(a: ast.AST, b: ast.AST) -> ast.AST:
+    if _is_constant(a, 0) or _is_constant(b, 0):
+        return(ast.Constant(0))
+    if _is_constant(a, 1):
+        return(b)
+    if _is_constant(b, 1):
+        return(a)
+    return(ast.BinOp(a, ast.Mult(), b))
+
+
+def _div(a: ast.AST, b: ast.AST) -> ast.AST:
+    if _is_constant(a, 0):
+        return(ast.Constant(0))
+    return(ast.BinOp(a, ast.Div(), b))
+
+
+def derivative(node: ast.AST, var: str) -> ast.AST:
+    """Derivative of an expression with respect to a variable
+
+    Supports +, -, *, /, powers with constant exponents and exp.
+    """
+    if isinstance(node, ast.Expression):
+        return(derivative(node.body, var))
+    elif isinstance(node, ast.Constant):
+        return(ast.Constant(0))
+    elif isinstance(node, ast.Name):
+        return(ast.Constant(1 if node.id == var else 0))
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        d = derivative(node.operand, var)
+        return(ast.Constant(0) if _is_constant(d, 0)
+               else ast.UnaryOp(ast.USub(), d))
+    elif isinstance(node, ast.BinOp):
+        a, b = node.left, node.right
+        da, db = derivative(a, var), derivative(b, var)
+        if isinstance(node.op, ast.Add):
+            return(_add(da, db))
+        elif isinstance(node.op, ast.Sub):
+            return(_sub(da, db))
+        elif isinstance(node.op, ast.Mult):
+            return(_add(_mul(da, b), _mul(a, db)))
+        elif isinstance(node.op, ast.Div):
+            # (a / b)' = a' / b - a * b' / b ** 2
+            return(_sub(_div(da, b),
+                        _div(_mul(a, db), ast.BinOp(b, ast.Pow(),
+                                                    ast.Constant(2)))))
+        elif isinstance(node.op, ast.Pow) and isinstance(b, ast.Constant):
+            power = ast.BinOp(a, ast.Pow(), ast.Constant(b.value - 1))
+            return(_mul(_mul(ast.Constant(b.value), power), da))
+    elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+          and node.func.id == 'exp' and len(node.args) == 1):
+        return(_mul(node, derivative(node.args[0], var)))
+    raise ValueError(f'Cannot differentiate {ast.unparse(node)}')
+
+
+def _names(node: ast.AST) -> set:
+    return({n.id for n in ast.walk(node) if isinstance(n, ast.Name)})
+
+
+def generate_source(table: dict) -> str:
+    """Source of the kernel module of a model definition"""
+    components = table['components']
+    processes = table['processes']
+    values = parameter_values()
+    m = stoichiometry(table)
+    rates = [ast.parse(p['rate'], mode='eval') for p in processes]
+    for process, rate in zip(processes, rates):
+        unknown = _names(rate) - set(components) - set(values) - {'T', 'exp'}
+        if unknown:
+            raise ValueError(f'Unknown names {sorted(unknown)} in the rate '
+                             f'of {process["name"]}')
+    used = sorted(set().union(*[_names(r) for r in rates]) & set(values))
+
+    lines = ['"""Generated by process_table.py, do not edit"""',
+             'import numpy as np',
+             'from numpy import exp',
+             '',
+             f'COMPONENTS = {components!r}',
+             f'PROCESSES = {[p["name"] for p in processes]!r}',
+             f'PETERSEN = np.array({m.tolist()!r})',
+             '']
+    lines += [f'{k} = {values[k]!r}' for k in used]
+    unpack = f'    ({", ".join(components)},) = C'
+    shape = '    shape = np.broadcast(*C, T).shape'
+
+    # Process rates
+    lines += ['', '', 'def process_rates(C, T):', unpack]
+    terms = ', '.join(ast.unparse(r) for r in rates)
+    lines += [f'    return(np.array(np.broadcast_arrays({terms})))']
+
+    # Net reaction rates, one product with the Petersen matrix
+    lines += ['', '', 'def reaction_rates(C, T):',
+              '    return(np.tensordot(PETERSEN, process_rates(C, T), '
+              'axes=(0, 0)))']
+
+    # Jacobian of the net reaction rates
+    lines += ['', '', 'def jacobian(C, T):', unpack, shape,
+              f'    J = np.zeros(({len(components)}, {len(components)})'
+              ' + shape)']
+    entries = {}
+    for i, rate in enumerate(rates):
+        for k in sorted(_names(rate) & set(components)):
+            d = derivative(rate, k)
+            if _is_constant(d, 0):
+                continue
+            name = f'd{i}_{k}'
+            lines.append(f'    {name} = {ast.unparse(d)}')
+            for j in range(len(components)):
+                if m[i, j] != 0:
+                    entries.setdefault((j, components.index(k)), []).append(
+                        f'{m[i, j]!r} * {name}')
+    for (j, k), terms in sorted(entries.items()):
+        lines.append(f'    J[{j}, {k}] = {" + ".join(terms)}')
+    lines += ['    return(J)', '']
+    return('\n'.join(lines))
+
+
+def definition_hash(table: dict) -> str:
+    """Hash of a model definition, the parameter values and the generator"""
+    with open(__file__, 'rb') as f:
+        generator = hashlib.sha256(f.read()).hexdigest()
+    description = json.dumps([table, parameter_values(), generator],
+                             sort_keys=True)
+    return(hashlib.sha256(description.encode()).hexdigest())
+
+
+class Kernel:
+    def __init__(self, table: dict = PROCESS_TABLE,
+                 directory: str = DEFAULT_DIRECTORY) -> None:
+        """Generated kernel of a model definition
+
+        Attributes of the generated module (process_rates, reaction_rates,
+        jacobian, PETERSEN, COMPONENTS and PROCESSES) are available on the
+        kernel. Unlike the module it can be pickled, it is loaded again from
+        its definition when unpickled.
+
+        Parameters
+        ----------
+        table: dict
+            Model definition, see PROCESS_TABLE
+        directory: str
+            Where generated kernels are stored
+        """
+        self.table = table
+        self.directory = directory
+        self.module = _load(definition_hash(table), json.dumps(table),
+                            directory)
+
+    def __getattr__(self, name: str):
+        if name == 'module':
+            raise AttributeError(name)
+        return(getattr(self.module, name))
+
+    def __getstate__(self) -> dict:
+        return({'table': self.table, 'directory': self.directory})
+
+    def __setstate__(self, attributes: dict) -> None:
+        self.__init__(attributes['table'], attributes['directory'])
+
+
+def compile_table(table: dict = PROCESS_TABLE,
+                  directory: str = DEFAULT_DIRECTORY) -> Kernel:
+    """Generate the kernel of a model definition
+
+    The generated source is stored in directory under the definition hash
+    and loaded from there if it already exists.
+
+    Parameters
+    ----------
+    table: dict
+        Model definition, see PROCESS_TABLE
+    directory: str
+        Where generated kernels are stored
+    Output
+    ------
+    kernel: Kernel
+        Kernel with process_rates, reaction_rates, jacobian, PETERSEN,
+        COMPONENTS and PROCESSES
+    """
+    return(Kernel(table, directory))
+
+
+def check_jacobian(kernel, C: np.ndarray = None, T: float = 20.0,
+                   seed: int = 0) -> float:
+    """Error of the jacobian of a kernel against central differences
+
+    Parameters
+    ----------
+    kernel: Kernel
+        Kernel or generated module to check
+    C: np.ndarray
+        Concentrations in kg/m^3 to check at, random ones between 1e-3 and
+        1 if None
+    T: float
+        Temperature in degrees Celsius
+    seed: int
+        Seed of the random concentrations
+    Output
+    ------
+    error: float
+        Largest difference relative to the largest jacobian entry
+    """
+    if C is None:
+        rng = np.random.default_rng(seed)
+        C = 10 ** rng.uniform(-3, 0, len(kernel.COMPONENTS))
+    J = kernel.jacobian(C, T)
+    J_fd = np.zeros_like(J)
+    for k in range(len(C)):
+        h = 1e-6 * C[k]
+        up, down = C.copy(), C.copy()
+        up[k] += h
+        down[k] -= h
+        J_fd[:, k] = (kernel.reaction_rates(up, T)
+                      - kernel.reaction_rates(down, T)) / (2 * h)
+    return(float(np.max(np.abs(J - J_fd)) / np.max(np.abs(J))))
+
+
+@functools.lru_cache(maxsize=None)
+def _load(key: str, table: str, directory: str):
+    file_path = os.path.join(directory, f'kernel_{key[:16]}.py')
+    if not os.path.isfile(file_path):
+        os.makedirs(directory, exist_ok=True)
+        source = generate_source(json.loads(table))
+        # Write then rename so other processes never load a partial file
+        tmp_path = f'{file_path[:-3]}_{os.getpid()}_tmp.py'
+        with open(tmp_path, 'w') as f:
+            f.write(source)
+        error = check_jacobian(_import(key, tmp_path))
+        if error > JACOBIAN_TOLERANCE:
+            os.remove(tmp_path)
+            raise ValueError(f'Generated jacobian differs from finite '
+                             f'differences by {error:.3g}')
+        os.replace(tmp_path, file_path)
+    return(_import(key, file_path))
+
+
+def _import(key: str, file_path: str):
+    spec = importlib.util.spec_from_file_location(f'kernel_{key[:16]}',
+                                                  file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return(module)
+
+
+def default_kernel() -> Kernel:
+    """Kernel of PROCESS_TABLE"""
+    return(compile_table(PROCESS_TABLE))
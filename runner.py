@@ -0,0 +1,365 @@
+"""Headless config-driven batch runner
+
+Runs scenario files through a job queue of worker processes without
+console output per step. Each scenario file is a JSON object, or a list of
+them, like
+
+    {
+        "name": "low_flux",
+        "state": {"Q_out": "15000 m**3/day", "v_sg": "1.5 cm/s"},
+        "time": "7 day",
+        "t_step": "15 min",
+        "integrator": "multirate",
+        "options": {"method": "bdf"},
+        "recorder": {"every": 4, "keys": ["TMP", "R_t", "S_NH"]},
+        "output": {"directory": "results", "format": "npz"}
+    }
+
+where state overrides variables of state.starting_state. Strings that start
+with a number are read as pint quantities, plain numbers are in the units
+of the state variable they replace. Only the name is required, see
+DEFAULT_SCENARIO for the defaults.
+
+Progress and job events are logged to stderr as one JSON object per line,
+progress at most once per progress interval. When all jobs are done a JSON
+summary with the runtime, steps per second and final state of every job is
+written to stdout and the exit status is 1 if any job failed.
+
+Methods
+-------
+parse_scenario -> dict
+    Scenario with quantities from its JSON description
+load_scenarios -> list
+    Scenarios of scenario files
+run_scenario -> tuple
+    Simulate one scenario
+run_batch -> dict
+    Simulate scenarios in a pool of worker processes
+"""
+import argparse
+import concurrent.futures
+import inspect
+import json
+import logging
+import os
+import re
+import sys
+import time as timer
+
+import pint
+
+import cache
+import metrics
+import simulation
+import state as state_module
+from parameters import ureg
+
+DEFAULT_SCENARIO = {
+    'state': {},
+    'time': '7 day',
+    't_step': '15 min',
+    'integrator': 'euler',
+    'options': {},
+    # Record every step and every variable
+    'recorder': {'every': 1, 'keys': None},
+    # Nothing is written if format is None, otherwise 'npz' or 'csv'
+    'output': {'directory': 'results', 'format': None},
+}
+NUMBER = re.compile(r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+
+logger = logging.getLogger('runner')
+
+
+class JSONFormatter(logging.Formatter):
+    """Log records as one JSON object per line"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': round(record.created, 3),
+                 'level': record.levelname,
+                 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        return(json.dumps(entry))
+
+
+def configure_logging(level: int = logging.INFO) -> None:
+    """Send the runner's logs to stderr as JSON lines
+
+    Also the initializer of run_batch's worker processes, which do not
+    inherit the handlers of the parent unless they are forked.
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JSONFormatter())
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def _log(event: str, level: int = logging.INFO, **fields) -> None:
+    logger.log(level, event, extra={'fields': fields})
+
+
+def _value(value, units: pint.Unit = None):
+    """Quantity of a JSON value, see the module docstring"""
+    match = NUMBER.match(value) if isinstance(value, str) else None
+    if match:
+        # Parsing the whole string multiplies the number with the units,
+        # which fails for offset units like degC
+        return(ureg.Quantity(float(match.group()),
+                             value[match.end():].strip()))
+    if isinstance(value, (int, float)) and units is not None:
+        return(ureg.Quantity(value, units))
+    return(value)
+
+
+def parse_scenario(raw: dict, base_state: dict = None) -> dict:
+    """Scenario with pint quantities from its JSON description
+
+    Raises a ValueError for mistakes that would otherwise only fail in a
+    worker: overrides in the wrong units, times that are not times,
+    options the model does not take and invalid recorder settings.
+
+    Parameters
+    ----------
+    raw: dict
+        JSON description of the scenario, see the module docstring
+    base_state: dict
+        State the overrides apply to, state.starting_state if None
+    Output
+    ------
+    scenario: dict
+        Complete scenario with the starting state under 'state'
+    """
+    if base_state is None:
+        base_state = state_module.starting_state
+    if 'name' not in raw:
+        raise ValueError('Scenario without a name')
+    unknown = set(raw) - set(DEFAULT_SCENARIO) - {'name'}
+    if unknown:
+        raise ValueError(f'Unknown scenario settings {sorted(unknown)}')
+    scenario = {k: raw.get(k, v) for k, v in DEFAULT_SCENARIO.items()}
+    scenario['name'] = raw['name']
+    for k in ['recorder', 'output']:
+        scenario[k] = {**DEFAULT_SCENARIO[k], **raw.get(k, {})}
+
+    state = base_state.copy()
+    for k, v in scenario['state'].items():
+        base = base_state.get(k)
+        units = base.units if isinstance(base, pint.Quantity) else None
+        state[k] = _value(v, units)
+        if units is not None and not (
+                isinstance(state[k], pint.Quantity)
+                and state[k].dimensionality == base.dimensionality):
+            raise ValueError(f'State variable {k} needs units of '
+                             f'{base.dimensionality}, got {v!r}')
+    scenario['state'] = state
+    for k in ['time', 't_step']:
+        scenario[k] = _value(scenario[k])
+        if not (isinstance(scenario[k], pint.Quantity)
+                and scenario[k].check('[time]')):
+            raise ValueError(f'{k} is not a time: {raw.get(k)!r}')
+    scenario['options'] = {k: _value(v)
+                           for k, v in scenario['options'].items()}
+    # Fail before the job is queued rather than in a worker
+    model_class = simulation.model_class(scenario['integrator'])
+    try:
+        inspect.signature(model_class).bind(state, **scenario['options'])
+    except TypeError as error:
+        raise ValueError(f'Invalid options for the {scenario["integrator"]} '
+                         f'integrator: {error}')
+    every = scenario['recorder']['every']
+    if isinstance(every, bool) or not isinstance(every, int) or every < 1:
+        raise ValueError(f'recorder every must be a positive integer, got '
+                         f'{every!r}')
+    keys = scenario['recorder']['keys']
+    if keys is not None:
+        unknown = [k for k in keys if k not in state]
+        if unknown:
+            raise ValueError(f'Unknown recorder keys {unknown}')
+    if scenario['output']['format'] not in (None, 'npz', 'csv'):
+        raise ValueError(f'Unknown output format '
+                         f'{scenario["output"]["format"]!r}')
+    return(scenario)
+
+
+def load_scenarios(file_paths: list) -> list:
+    """Scenarios of scenario files, see parse_scenario
+
+    Scenarios without a name are named after their file.
+    """
+    scenarios = []
+    for file_path in file_paths:
+        with open(file_path) as f:
+            raws = json.load(f)
+        if isinstance(raws, dict):
+            raws = [raws]
+        stem = os.path.splitext(os.path.basename(file_path))[0]
+        for i, raw in enumerate(raws):
+            if 'name' not in raw:
+                raw = {'name': stem if len(raws) == 1 else f'{stem}_{i}',
+                       **raw}
+            scenarios.append(parse_scenario(raw))
+    return(scenarios)
+
+
+def write_csv(file_path: str, trajectory: dict) -> None:
+    """Write a trajectory as columns of base unit magnitudes
+
+    The header follows MBRModel.record_state.
+    """
+    keys = list(trajectory)
+    columns = []
+    header = []
+    for k in keys:
+        v = trajectory[k]
+        if isinstance(v, pint.Quantity):
+            header.append(f'{k} [{v.to_base_units().units}]')
+            columns.append(v.to_base_units().magnitude)
+        else:
+            header.append(f'{k} [-]')
+            columns.append(v)
+    with open(file_path, 'w') as f:
+        f.write(', '.join(header) + '\n')
+        for row in zip(*columns):
+            f.write(', '.join(str(value) for value in row) + '\n')
+
+
+def run_scenario(scenario: dict, progress_interval: float = 10.0) -> tuple:
+    """Simulate one scenario
+
+    Parameters
+    ----------
+    scenario: dict
+        See parse_scenario
+    progress_interval: float
+        Least wall time in seconds between two progress log entries
+    Output
+    ------
+    summary: dict
+        Name, status, runtime in seconds, number of steps, steps per
+        second, output file and final state in base units
+    state: dict
+        The final state
+    """
+    start = timer.perf_counter()
+    name = scenario['name']
+    recorder = scenario['recorder']
+    output = scenario['output']
+    time = scenario['time']
+    t_step = scenario['t_step']
+    model = simulation.model_class(scenario['integrator'])(
+        scenario['state'].copy(), **scenario['options'])
+    _log('started', job=name)
+
+    record = output['format'] is not None
+    states = []
+    steps = 0
+    t = 0 * ureg.s
+    last_report = start
+    while t < time:
+        state = model.step_model(t_step)
+        steps += 1
+        t += t_step
+        if record and steps % recorder['every'] == 0:
+            if recorder['keys'] is not None:
+                state = {k: state[k] for k in ['time'] + recorder['keys']}
+            states.append(state)
+        now = timer.perf_counter()
+        if now - last_report >= progress_interval:
+            last_report = now
+            _log('progress', job=name, fraction=float(t / time),
+                 days=t.to(ureg.day).magnitude,
+                 steps_per_second=steps / (now - start))
+
+    file_path = None
+    if record and states:
+        os.makedirs(output['directory'], exist_ok=True)
+        file_path = os.path.join(output['directory'],
+                                 f'{name}.{output["format"]}')
+        trajectory = metrics.stack_states(states)
+        if output['format'] == 'npz':
+            cache.save_trajectory(file_path, trajectory)
+        else:
+            write_csv(file_path, trajectory)
+    runtime = timer.perf_counter() - start
+    summary = {'name': name, 'status': 'ok', 'runtime': runtime,
+               'steps': steps, 'steps_per_second': steps / runtime,
+               'output': file_path,
+               'state': state_module.serialize_state(model.state)}
+    _log('finished', job=name, runtime=runtime, steps=steps)
+    return(summary, model.state)
+
+
+def _job(scenario: dict, progress_interval: float) -> dict:
+    try:
+        summary, _ = run_scenario(scenario, progress_interval)
+    except Exception as error:
+        _log('failed', logging.ERROR, job=scenario['name'],
+             error=repr(error))
+        summary = {'name': scenario['name'], 'status': 'failed',
+                   'error': repr(error)}
+    return(summary)
+
+
+def run_batch(scenarios: list, workers: int = None,
+              progress_interval: float = 10.0) -> dict:
+    """Simulate scenarios in a pool of worker processes
+
+    Parameters
+    ----------
+    scenarios: list
+        See parse_scenario
+    workers: int
+        Number of worker processes, one per CPU if None
+    progress_interval: float
+        See run_scenario
+    Output
+    ------
+    summary: dict
+        Runtime in seconds, job counts, total steps per second and the
+        summary of every job in the order of scenarios
+    """
+    start = timer.perf_counter()
+    _log('batch started', jobs=len(scenarios), workers=workers)
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=configure_logging,
+            initargs=(logger.getEffectiveLevel(),)) as executor:
+        futures = [executor.submit(_job, s, progress_interval)
+                   for s in scenarios]
+        done = 0
+        for future in concurrent.futures.as_completed(futures):
+            done += 1
+            result = future.result()
+            _log('job done', job=result['name'], status=result['status'],
+                 done=done, jobs=len(scenarios))
+        results = [f.result() for f in futures]
+    runtime = timer.perf_counter() - start
+    steps = sum(r.get('steps', 0) for r in results)
+    summary = {'runtime': runtime, 'jobs': len(results),
+               'failed': sum(r['status'] != 'ok' for r in results),
+               'steps': steps, 'steps_per_second': steps / runtime,
+               'results': results}
+    _log('batch finished', runtime=runtime, failed=summary['failed'])
+    return(summary)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='+',
+                        help='JSON scenario files')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, one per CPU by default')
+    parser.add_argument('--progress-interval', type=float, default=10.0,
+                        help='seconds between progress log entries')
+    parser.add_argument('--quiet', action='store_true',
+                        help='log warnings and errors only')
+    args = parser.parse_args()
+
+    configure_logging(logging.WARNING if args.quiet else logging.INFO)
+    try:
+        scenarios = load_scenarios(args.scenarios)
+    except (OSError, ValueError, pint.PintError) as error:
+        _log('invalid scenarios', logging.ERROR, error=repr(error))
+        sys.exit(2)
+    summary = run_batch(scenarios, args.workers, args.progress_interval)
+    json.dump(summary, sys.stdout)
+    sys.stdout.write('\n')
+    sys.exit(1 if summary['failed'] else 0)
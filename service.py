@@ -0,0 +1,420 @@
+"""Real-time digital-twin service
+
+Runs an MBRModel next to the plant and keeps it synchronised with timestamped
+sensor measurements. Three asyncio tasks cooperate:
+
+- ingestion reads measurements from a pluggable source and queues them,
+- the update loop advances the model to each measurement time,
+- the forecast loop runs a faster-than-real-time forecast from the latest
+  state.
+
+Model stepping runs in a worker thread so the event loop (and therefore
+ingestion and client requests) is never blocked by a step. Forecasts run in
+a worker process: stepping is pint-heavy Python that holds the GIL, so a
+forecast thread would compete with state updates.
+If measurements arrive faster than the model can be advanced, queued
+measurements are coalesced into the newest one, so the backlog (and the
+latency from measurement to updated state) cannot grow without bound.
+A measured feed flow also sets the permeate flow unless the permeate flow is
+measured too, so the twin holds the tank level like the plant does, and
+updates that would empty the tank are rejected.
+
+Clients connect over TCP and send one command per line (``state``,
+``forecast`` or ``stats``), each answered with one line of JSON.
+
+Classes
+-------
+MeasurementSource
+    Base class for measurement sources
+ReplaySource
+    Replays measurements from a csv file
+SocketSource
+    Reads JSON line measurements from a TCP socket
+DigitalTwin
+    The digital-twin service
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import copy
+import csv
+import json
+import math
+import time
+
+import pint
+
+import integrated_model
+from parameters import ureg
+import state as state_module
+
+# Measured variables, the state variable they update and the units they are
+# reported in. Times are seconds since the start of the model.
+MEASUREMENT_UNITS = {
+    'time': ureg.s,
+    'Q_in': ureg.m ** 3 / ureg.day,
+    'Q_out': ureg.m ** 3 / ureg.day,
+    'temperature': ureg.degC,
+    'DO': ureg.mg / ureg.L,
+    'TMP': ureg.kPa,
+}
+MEASUREMENT_STATES = {
+    'Q_in': 'Q_in',
+    'Q_out': 'Q_out',
+    'temperature': 'temperature',
+    'DO': 'S_O',
+}
+# State variables included in forecasts
+FORECAST_VARIABLES = ['S_O', 'S_NH', 'S_NO', 'X_EPS', 'S_UAP', 'S_BAP',
+                      'R_t', 'TMP']
+
+
+def parse_measurement(record: dict) -> dict:
+    """Convert a record of plain numbers into a measurement
+
+    Parameters
+    ----------
+    record: dict
+        Measured values keyed by the names in MEASUREMENT_UNITS, given in
+        those units. Missing or empty values are skipped.
+    Output
+    ------
+    measurement: dict
+        The measured values as pint.Quantity objects
+    """
+    measurement = {}
+    for k, units in MEASUREMENT_UNITS.items():
+        value = record.get(k)
+        if value is None or value == '':
+            continue
+        measurement[k] = ureg.Quantity(float(value), units)
+    if 'time' not in measurement:
+        raise ValueError('Measurements must include a time')
+    return(measurement)
+
+
+def run_forecast(model: integrated_model.MBRModel,
+                 horizon: pint.Quantity, t_step: pint.Quantity) -> list:
+    """Simulate forward from the state of a model
+
+    Parameters
+    ----------
+    model: integrated_model.MBRModel
+        Model at the state to start the forecast from, it is advanced
+    horizon: pint.Quantity
+        How far ahead to forecast
+    t_step: pint.Quantity
+        Time step of the forecast
+    Output
+    ------
+    forecast: list
+        One dict per forecast step with the time and FORECAST_VARIABLES
+    """
+    keys = ['time'] + FORECAST_VARIABLES
+    end = model.state['time'] + horizon
+    forecast = [{k: model.state[k] for k in keys}]
+    while model.state['time'] < end:
+        model.step_model(t_step)
+        forecast.append({k: model.state[k] for k in keys})
+    return(forecast)
+
+
+class MeasurementSource:
+    """Base class for measurement sources
+
+    Subclasses implement ``stream`` as an async generator yielding
+    measurements (see parse_measurement) in time order.
+    """
+    async def stream(self):
+        raise NotImplementedError
+        yield
+
+
+class ReplaySource(MeasurementSource):
+    def __init__(self, file_path: str, speed: float = None) -> None:
+        """Replay measurements from a csv file
+
+        Parameters
+        ----------
+        file_path: str
+            csv file with a header row naming the columns after the keys of
+            MEASUREMENT_UNITS
+        speed: float
+            Replay speed relative to real time, measurements are replayed as
+            fast as possible if None
+        """
+        self.file_path = file_path
+        self.speed = speed
+
+    async def stream(self):
+        with open(self.file_path, newline='') as f:
+            rows = csv.DictReader(f)
+            previous = None
+            while True:
+                # Read row by row off the event loop
+                row = await asyncio.to_thread(next, rows, None)
+                if row is None:
+                    break
+                m = parse_measurement(row)
+                if self.speed is not None and previous is not None:
+                    delay = (m['time'] - previous).to(ureg.s).magnitude
+                    await asyncio.sleep(max(delay, 0) / self.speed)
+                previous = m['time']
+                yield m
+
+
+class SocketSource(MeasurementSource):
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765) -> None:
+        """Read measurements sent as JSON lines over a TCP connection
+
+        Parameters
+        ----------
+        host: str
+            Host to connect to
+        port: int
+            Port to connect to
+        """
+        self.host = host
+        self.port = port
+
+    async def stream(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    yield parse_measurement(json.loads(line))
+        finally:
+            writer.close()
+
+
+class DigitalTwin:
+    def __init__(self, model: integrated_model.MBRModel,
+                 t_step: pint.Quantity = 60 * 5 * ureg.s,
+                 forecast_horizon: pint.Quantity = 1 * ureg.day,
+                 forecast_step: pint.Quantity = 60 * 15 * ureg.s,
+                 queue_size: int = 16) -> None:
+        """Digital-twin service around an integrated model
+
+        Parameters
+        ----------
+        model: integrated_model.MBRModel
+            The model to keep synchronised with the plant
+        t_step: pint.Quantity
+            Largest time step used to advance the model to a measurement
+        forecast_horizon: pint.Quantity
+            How far ahead of the latest state forecasts are run
+        forecast_step: pint.Quantity
+            Time step used by forecasts
+        queue_size: int
+            Number of measurements held before they are coalesced
+        """
+        self.model = model
+        self.t_step = t_step
+        self.forecast_horizon = forecast_horizon
+        self.forecast_step = forecast_step
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.snapshot = dict(model.state)
+        self.forecast = []
+        self.residuals = {}
+        self.latencies = collections.deque(maxlen=1000)
+        self.counts = {'received': 0, 'applied': 0, 'coalesced': 0,
+                       'stale': 0, 'rejected': 0, 'forecasts': 0}
+        self._ingesting = False
+        self._done = False
+        self._new_state = asyncio.Event()
+        self._step_executor = concurrent.futures.ThreadPoolExecutor(1)
+        # A process, so forecasts do not hold the GIL the step thread needs
+        self._forecast_executor = concurrent.futures.ProcessPoolExecutor(1)
+
+    async def ingest(self, source: MeasurementSource) -> None:
+        """Queue measurements from a source without ever waiting on the model
+        """
+        try:
+            async for m in source.stream():
+                m['received'] = time.perf_counter()
+                self.counts['received'] += 1
+                if self.queue.full():
+                    # Drop the oldest, its time is covered by newer readings
+                    self.queue.get_nowait()
+                    self.counts['coalesced'] += 1
+                self.queue.put_nowait(m)
+        finally:
+            self._ingesting = False
+            # Wake the update loop so it can notice the source has ended
+            if self.queue.full():
+                self.queue.get_nowait()
+                self.counts['coalesced'] += 1
+            self.queue.put_nowait(None)
+
+    async def update_loop(self) -> None:
+        """Advance the model to the time of each queued measurement"""
+        loop = asyncio.get_running_loop()
+        while self._ingesting or not self.queue.empty():
+            m = await self.queue.get()
+            if m is None:
+                continue
+            # Coalesce everything that queued up while the last update ran
+            while not self.queue.empty():
+                newer = self.queue.get_nowait()
+                if newer is None:
+                    continue
+                self.counts['coalesced'] += 1
+                m = newer
+            if m['time'] <= self.model.state['time']:
+                self.counts['stale'] += 1
+                continue
+            try:
+                snapshot = await loop.run_in_executor(self._step_executor,
+                                                      self.advance, m)
+            except ValueError:
+                self.counts['rejected'] += 1
+                continue
+            self.snapshot = snapshot
+            self.latencies.append(time.perf_counter() - m['received'])
+            self.counts['applied'] += 1
+            self._new_state.set()
+        self._done = True
+        self._new_state.set()
+
+    def advance(self, measurement: dict) -> dict:
+        """Step the model to a measurement time and apply the measurement
+
+        Without a measured permeate flow the permeate follows the measured
+        feed flow, which holds the tank level as the plant's level control
+        does. An update that empties the tank is rejected and the model is
+        left at its state before the update.
+
+        Parameters
+        ----------
+        measurement: dict
+            See parse_measurement
+        Output
+        ------
+        snapshot: dict
+            Copy of the updated model state
+        """
+        previous = dict(self.model.state)
+        remaining = measurement['time'] - self.model.state['time']
+        n_steps = math.ceil((remaining / self.t_step).to('').magnitude)
+        t_step = remaining / n_steps
+        for _ in range(n_steps):
+            self.model.step_model(t_step)
+        if not self.model.state['volume'].magnitude > 0:
+            self.model.state = previous
+            raise ValueError(f'The update to {measurement["time"]} empties '
+                             f'the tank')
+        for k, key in MEASUREMENT_STATES.items():
+            if k in measurement:
+                self.model.state[key] = measurement[k]
+        if 'Q_in' in measurement and 'Q_out' not in measurement:
+            self.model.state['Q_out'] = measurement['Q_in']
+        if 'TMP' in measurement:
+            self.residuals['TMP'] = (measurement['TMP']
+                                     - self.model.state['TMP'])
+        return(dict(self.model.state))
+
+    async def forecast_loop(self) -> None:
+        """Forecast from the newest state whenever the state changes"""
+        loop = asyncio.get_running_loop()
+        forecast_snapshot = None
+        while not (self._done and forecast_snapshot is self.snapshot):
+            await self._new_state.wait()
+            self._new_state.clear()
+            if forecast_snapshot is self.snapshot:
+                continue
+            forecast_snapshot = self.snapshot
+            # Same model components as the twin, started from the snapshot
+            model = copy.copy(self.model)
+            model.state = dict(forecast_snapshot)
+            self.forecast = await loop.run_in_executor(
+                self._forecast_executor, run_forecast, model,
+                self.forecast_horizon, self.forecast_step)
+            self.counts['forecasts'] += 1
+
+    def stats(self) -> dict:
+        """Counters and measurement-to-state latency statistics in seconds"""
+        stats = dict(self.counts)
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            stats['latency_mean'] = sum(latencies) / len(latencies)
+            stats['latency_p95'] = latencies[int(0.95 * (len(latencies) - 1))]
+            stats['latency_max'] = latencies[-1]
+        return(stats)
+
+    def respond(self, command: str) -> dict:
+        """Build the reply to a client command"""
+        if command == 'state':
+            return(state_module.serialize_state(self.snapshot))
+        elif command == 'forecast':
+            return({'forecast': [state_module.serialize_state(f)
+                                 for f in self.forecast]})
+        elif command == 'stats':
+            residuals = state_module.serialize_state(self.residuals)
+            return({**self.stats(), 'residuals': residuals})
+        return({'error': f'Unknown command {command!r}'})
+
+    async def handle_client(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = self.respond(line.decode().strip())
+                writer.write((json.dumps(reply) + '\n').encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def run(self, source: MeasurementSource, host: str = None,
+                  port: int = 8766) -> dict:
+        """Run the service until the source is exhausted
+
+        Parameters
+        ----------
+        source: MeasurementSource
+            Where measurements come from
+        host: str
+            Address to serve clients on, clients are not served if None
+        port: int
+            Port to serve clients on
+        Output
+        ------
+        stats: dict
+            See DigitalTwin.stats
+        """
+        self._ingesting = True
+        self._done = False
+        server = None
+        if host is not None:
+            server = await asyncio.start_server(self.handle_client, host, port)
+        try:
+            await asyncio.gather(self.ingest(source), self.update_loop(),
+                                 self.forecast_loop())
+        finally:
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+            self._step_executor.shutdown()
+            self._forecast_executor.shutdown()
+        return(self.stats())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('measurements', help='csv file of measurements')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='replay speed relative to real time')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    twin = DigitalTwin(integrated_model.MBRModel(
+        state_module.starting_state.copy()))
+    stats = asyncio.run(twin.run(ReplaySource(args.measurements, args.speed),
+                                 args.host, args.port))
+    print(json.dumps(stats))
@@ -0,0 +1,68 @@
+"""Running the integrated model over a time horizon
+
+Methods
+-------
+model_class -> type
+    The model class of an integrator
+run -> dict
+    Simulate from a starting state and return the trajectory
+"""
+from typing import Callable
+
+import pint
+
+import integrated_model
+import metrics
+import multirate
+from parameters import ureg
+
+
+def model_class(integrator: str) -> type:
+    """The model class of an integrator
+
+    Parameters
+    ----------
+    integrator: str
+        'euler' for the monolithic solve (MBRModel) or 'multirate' for
+        multirate.MultirateModel
+    """
+    models = {'euler': integrated_model.MBRModel,
+              'multirate': multirate.MultirateModel}
+    if integrator not in models:
+        raise ValueError(f'Unknown integrator {integrator!r}')
+    return(models[integrator])
+
+
+def run(state: dict, time: pint.Quantity, t_step: pint.Quantity,
+        progress: Callable = None, integrator: str = 'euler',
+        **options) -> dict:
+    """Simulate the integrated model
+
+    Parameters
+    ----------
+    state: dict
+        Starting state, see state.py. It is not modified.
+    time: pint.Quantity
+        Length of the simulation
+    t_step: pint.Quantity
+        The time step, the macro step for the multirate integrator
+    progress: Callable
+        Called with the simulated time before every step
+    integrator: str
+        See model_class
+    options:
+        Passed on to the model constructor
+    Output
+    ------
+    trajectory: dict
+        The state after every step, see metrics.stack_states
+    """
+    model = model_class(integrator)(state.copy(), **options)
+    t = 0 * ureg.s
+    states = []
+    while t < time:
+        if progress is not None:
+            progress(t)
+        states.append(model.step_model(t_step))
+        t += t_step
+    return(metrics.stack_states(states))
@@ -1,3 +1,5 @@
+import pint
+
 import parameters
 from parameters import ureg
 
@@ -63,3 +65,13 @@ X_TSS = 0.75 * (starting_state['X_S'] + starting_state['X_H']
                 + starting_state['X_A'] + starting_state['X_P']
                 + starting_state['X_I'] + starting_state['X_EPS'])
 starting_state['X_TSS'] = X_TSS
+
+
+def serialize_state(state: dict) -> dict:
+    """Convert a state into JSON serializable base unit magnitudes"""
+    serialized = {}
+    for k, v in state.items():
+        if isinstance(v, pint.Quantity):
+            v = v.to_base_units().magnitude
+        serialized[k] = v
+    return(serialized)